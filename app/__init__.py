@@ -1,12 +1,17 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 
 from app.config import Config
 
 app = Flask(__name__)
 app.config.from_object(Config)
-db = SQLAlchemy(app)
+app.logger.setLevel(app.config['LOG_LEVEL'])
 
+from app.replicas import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy(app)
+
+from app import connections
+from app import metrics
 from app import models
 
 db.create_all()
@@ -0,0 +1,320 @@
+import io
+import mmap
+import os
+import shutil
+import stat
+import tempfile
+from collections import Counter
+from datetime import datetime
+
+import numpy
+from flask import abort
+
+from app import app, db, ingest, metrics, stats, presents
+from app.models import Citizen, Import, relatives_table
+from app.snapshots import Snapshot
+from app.validate import LETTER_OR_DIGIT, relation_errors, edges_symmetric
+
+# binary citizens file, moves whole imports without JSON encoding and parsing
+# columns have fixed width and are stored one after another, so a file opened with mmap
+# is read as numpy arrays without copying (CitizenFile), string columns are indexes in a shared string table
+#
+# layout, little-endian, every section starts at a multiple of 8 bytes:
+#   header          HEADER
+#   citizen_ids     int64[count], strictly increasing
+#   apartments      int64[count]
+#   birth_dates     datetime64[D][count]
+#   towns, streets, buildings, names    int32[count] each, indexes in the string table
+#   genders         uint8[count], index in GENDERS
+#   offsets         int64[count + 1]
+#   relatives       int64[relations], positions of relatives of citizen i are relatives[offsets[i]:offsets[i + 1]]
+#   string_offsets  int64[strings + 1], string i is string_data[string_offsets[i]:string_offsets[i + 1]]
+#   string_data     uint8[string_bytes], UTF-8
+#
+# command line interface is in app/transfer.py
+
+MAGIC = b'CITIZENS'
+VERSION = 1
+MIMETYPE = 'application/octet-stream'
+HEADER = numpy.dtype([('magic', 'S8'), ('version', '<u4'), ('reserved', '<u4'), ('count', '<u8'),
+                      ('relations', '<u8'), ('strings', '<u8'), ('string_bytes', '<u8')])
+GENDERS = ('male', 'female')
+STRING_COLUMNS = ('towns', 'streets', 'buildings', 'names')
+
+
+def _sections(count: int, relations: int, strings: int, string_bytes: int) -> list:
+    return [('citizen_ids', '<i8', count), ('apartments', '<i8', count), ('birth_dates', '<M8[D]', count)] + \
+        [(column, '<i4', count) for column in STRING_COLUMNS] + \
+        [('genders', 'u1', count), ('offsets', '<i8', count + 1), ('relatives', '<i8', relations),
+         ('string_offsets', '<i8', strings + 1), ('string_data', 'u1', string_bytes)]
+
+
+def _layout(count: int, relations: int, strings: int, string_bytes: int) -> tuple:
+    # returns ([(name, dtype, offset, length), ...], file size)
+    layout = []
+    position = HEADER.itemsize
+    for name, dtype, length in _sections(count, relations, strings, string_bytes):
+        layout.append((name, numpy.dtype(dtype), position, length))
+        position += -(-numpy.dtype(dtype).itemsize * length // 8) * 8
+    return layout, position
+
+
+class CitizenFile(object):
+    # columns of a citizens file as read-only views of the buffer
+    # raises ValueError if the buffer is not a citizens file
+
+    def __init__(self, buffer):
+        if len(buffer) < HEADER.itemsize:
+            raise ValueError('File is too short.')
+        # header is copied, so a rejected mapping can be closed right away
+        header = numpy.frombuffer(bytes(buffer[:HEADER.itemsize]), HEADER, 1)[0]
+        if header['magic'] != MAGIC:
+            raise ValueError('Not a citizens file.')
+        if header['version'] != VERSION:
+            raise ValueError('Unsupported citizens file version {}.'.format(header['version']))
+        self.count = int(header['count'])
+        self.relations = int(header['relations'])
+        layout, size = _layout(self.count, self.relations, int(header['strings']), int(header['string_bytes']))
+        if size != len(buffer):
+            raise ValueError('File size {} does not match header, expected {}.'.format(len(buffer), size))
+        for name, dtype, offset, length in layout:
+            setattr(self, name, numpy.frombuffer(buffer, dtype, length, offset))
+        self._buffer = buffer
+        self._strings = None
+
+    @classmethod
+    def open(cls, fileobj):
+        # maps an open binary file, the file may be closed afterwards
+        status = os.fstat(fileobj.fileno())
+        if not stat.S_ISREG(status.st_mode):
+            raise ValueError('Not a regular file.')
+        if status.st_size < HEADER.itemsize:
+            raise ValueError('File is too short.')
+        mapping = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(mapping)
+        except ValueError:
+            mapping.close()
+            raise
+
+    def close(self):
+        # views have to be released before the mapping is closed
+        for name, _, _ in _sections(0, 0, 0, 0):
+            delattr(self, name)
+        if isinstance(self._buffer, mmap.mmap):
+            try:
+                self._buffer.close()
+            except BufferError:
+                # views are still referenced (e.g. by a traceback), mapping is closed once they are collected
+                pass
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def strings(self) -> list:
+        # decoded string table, raises ValueError if it is malformed
+        if self._strings is None:
+            bounds = self.string_offsets
+            if bounds[0] != 0 or bounds[-1] != len(self.string_data) or (numpy.diff(bounds) < 0).any():
+                raise ValueError('String table is malformed.')
+            data = self.string_data.tobytes()
+            bounds = bounds.tolist()
+            self._strings = [data[start:stop].decode() for start, stop in zip(bounds, bounds[1:])]
+        return self._strings
+
+    def validate(self):
+        # same rules as CitizenSchema and relation checks of POST /imports
+        # raises ValueError with description of the first broken rule
+        strings = self.strings
+        for column in STRING_COLUMNS:
+            codes = getattr(self, column)
+            if len(codes) and (codes.min() < 0 or codes.max() >= len(strings)):
+                raise ValueError('Column {} refers to unknown strings.'.format(column))
+        if (self.citizen_ids < 0).any() or (numpy.diff(self.citizen_ids) <= 0).any():
+            raise ValueError('Citizen ids are not unique or not sorted.')
+        if (self.apartments < 0).any():
+            raise ValueError('Apartment can not be negative.')
+        if (self.genders >= len(GENDERS)).any():
+            raise ValueError('Unknown gender.')
+        today = numpy.datetime64(datetime.utcnow().date(), 'D')
+        # NaT fails both comparisons
+        if not ((self.birth_dates >= numpy.datetime64('0001-01-01')) & (self.birth_dates <= today)).all():
+            raise ValueError('Birth day can not be in the future.')
+
+        places = numpy.array([1 <= len(value) <= 1000 and LETTER_OR_DIGIT.search(value) is not None
+                              for value in strings], dtype=bool)
+        names = numpy.array([len(value) > 0 for value in strings], dtype=bool)
+        for column in ('towns', 'streets', 'buildings'):
+            if not places[getattr(self, column)].all():
+                raise ValueError('Field {} has to contain 1 to 1000 symbols with at least 1 letter or digit.'.format(
+                    column[:-1]))
+        if not names[self.names].all():
+            raise ValueError('Name can not be empty.')
+
+        offsets = self.offsets
+        if offsets[0] != 0 or offsets[-1] != self.relations or (numpy.diff(offsets) < 0).any():
+            raise ValueError('Relatives offsets are malformed.')
+        relatives = self.relatives
+        if len(relatives) and (relatives.min() < 0 or relatives.max() >= self.count):
+            raise ValueError('Relatives refer to unknown citizens.')
+        # citizen id 0 is allowed, but ids of relatives start from 1
+        if len(relatives) and (self.citizen_ids[relatives] < 1).any():
+            raise ValueError('Relative ids have to be at least 1.')
+        # every row is strictly increasing, so relations are unique
+        increasing = numpy.diff(relatives) > 0
+        row_starts = offsets[(offsets > 0) & (offsets < self.relations)]
+        increasing[row_starts - 1] = True
+        if not increasing.all():
+            raise ValueError('Citizen have inconsistent list of relatives.')
+        holders = numpy.repeat(numpy.arange(self.count), numpy.diff(offsets))
+        if not edges_symmetric(holders, relatives):
+            ids = self.citizen_ids.tolist()
+            relations = {citizen_id: [] for citizen_id in ids}
+            for holder, relative in zip(holders.tolist(), relatives.tolist()):
+                relations[ids[holder]].append(ids[relative])
+            raise ValueError('\n'.join(relation_errors(relations)))
+
+    def citizens(self, start: int, stop: int) -> list:
+        # citizens at positions [start, stop) as dicts accepted by ingest.bulk_insert() (without import_id)
+        strings = self.strings
+        ids = self.citizen_ids
+        offsets = self.offsets[start:stop + 1].tolist()
+        columns = zip(ids[start:stop].tolist(), *(getattr(self, column)[start:stop].tolist()
+                                                  for column in STRING_COLUMNS),
+                      self.apartments[start:stop].tolist(),
+                      self.birth_dates[start:stop].astype('datetime64[us]').astype(object).tolist(),
+                      self.genders[start:stop].tolist(), offsets, offsets[1:])
+        return [dict(
+            citizen_id=citizen_id,
+            town=strings[town],
+            street=strings[street],
+            building=strings[building],
+            apartment=apartment,
+            name=strings[name],
+            birth_date=birth_date,
+            gender=GENDERS[gender],
+            relatives=ids[self.relatives[first:last]].tolist()
+        ) for citizen_id, town, street, building, name, apartment, birth_date, gender, first, last in columns]
+
+    def histogram(self) -> Counter:
+        # {(town, birth_date): count}, same as stats.add_import() builds
+        keys, counts = numpy.unique(numpy.stack([self.towns.astype(numpy.int64),
+                                                 self.birth_dates.astype(numpy.int64)]), axis=1, return_counts=True)
+        strings = self.strings
+        histogram = Counter()
+        dates = keys[1].astype('datetime64[D]').astype('datetime64[us]').astype(object).tolist()
+        for town, birth_date, count in zip(keys[0].tolist(), dates, counts.tolist()):
+            histogram[strings[town], birth_date] += count
+        return histogram
+
+    def snapshot(self) -> Snapshot:
+        # analytics snapshot sharing ids and birth dates with the file
+        # (so it has to be released before the file is closed)
+        codes, towns = numpy.unique(self.towns, return_inverse=True)
+        strings = self.strings
+        return Snapshot(None, 0, self.citizen_ids, [strings[code] for code in codes.tolist()],
+                        towns.astype(numpy.int32), self.birth_dates)
+
+
+def dump(import_id: int) -> list:
+    # returns citizens file of the import as a list of chunks
+    citizens = db.session.query(Citizen.citizen_id, Citizen.apartment, Citizen.birth_date, Citizen.town,
+                                Citizen.street, Citizen.building, Citizen.name, Citizen.gender) \
+        .filter(Citizen.import_id == import_id) \
+        .order_by(Citizen.citizen_id) \
+        .all()
+    relations = db.session.query(relatives_table.c.citizen_id, relatives_table.c.relative_id) \
+        .filter(relatives_table.c.import_id == import_id) \
+        .order_by(relatives_table.c.citizen_id, relatives_table.c.relative_id) \
+        .all()
+    metrics.add_rows(len(citizens) + len(relations))
+
+    string_codes = {}
+    columns = {column: numpy.empty(len(citizens), dtype=numpy.int32) for column in STRING_COLUMNS}
+    for position, row in enumerate(citizens):
+        for column, value in zip(STRING_COLUMNS, row[3:7]):
+            columns[column][position] = string_codes.setdefault(value, len(string_codes))
+    encoded = [value.encode() for value in string_codes]
+
+    citizen_ids = numpy.array([row[0] for row in citizens], dtype=numpy.int64)
+    relations = numpy.array(relations, dtype=numpy.int64).reshape(-1, 2)
+    # rows are ordered by (citizen_id, relative_id), so every CSR row is sorted
+    holders = numpy.searchsorted(citizen_ids, relations[:, 0])
+    arrays = dict(
+        citizen_ids=citizen_ids,
+        apartments=numpy.array([row[1] for row in citizens], dtype=numpy.int64),
+        birth_dates=numpy.array([row[2] for row in citizens], dtype='datetime64[D]'),
+        genders=numpy.array([GENDERS.index(row[7]) for row in citizens], dtype=numpy.uint8),
+        offsets=numpy.concatenate([[0], numpy.cumsum(numpy.bincount(holders, minlength=len(citizens)))]),
+        relatives=numpy.searchsorted(citizen_ids, relations[:, 1]),
+        string_offsets=numpy.concatenate([[0], numpy.cumsum([len(value) for value in encoded])]),
+        string_data=numpy.frombuffer(b''.join(encoded), numpy.uint8),
+        **columns
+    )
+
+    header = numpy.array([(MAGIC, VERSION, 0, len(citizens), len(relations), len(encoded),
+                           len(arrays['string_data']))], dtype=HEADER)
+    chunks = [header.tobytes()]
+    layout, size = _layout(len(citizens), len(relations), len(encoded), len(arrays['string_data']))
+    for name, dtype, offset, length in layout:
+        data = arrays[name].astype(dtype).tobytes()
+        chunks.append(data + b'\0' * (-len(data) % 8))
+    return chunks
+
+
+def import_stream(stream) -> int:
+    # stores import read from a binary stream with citizens file
+    # regular files are mapped directly, other streams (including sockets and pipes) are spooled to a temporary file
+    # aborts with 400 if data is invalid, returns new import id
+    if not _regular_file(stream):
+        spool_dir = app.config['IMPORT_SPOOL_DIR'] or tempfile.gettempdir()
+        with tempfile.TemporaryFile(dir=spool_dir, prefix='import-', suffix='.citizens') as spool:
+            shutil.copyfileobj(stream, spool)
+            spool.flush()
+            return import_stream(spool)
+
+    try:
+        data = CitizenFile.open(stream)
+    except ValueError as e:
+        abort(400, str(e))
+    with data:
+        try:
+            data.validate()
+        except ValueError as e:
+            error = str(e)
+        else:
+            return store(data)
+    abort(400, error)
+
+
+def _regular_file(stream) -> bool:
+    try:
+        return stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+
+
+def store(data: CitizenFile) -> int:
+    # inserts validated file as a new import in batches of IMPORT_STREAM_BATCH_SIZE citizens
+    new_import = Import(citizens_count=data.count)
+    db.session.add(new_import)
+    db.session.flush()
+    import_id = new_import.id
+    batch_size = app.config['IMPORT_STREAM_BATCH_SIZE']
+    for start in range(0, data.count, batch_size):
+        citizens = data.citizens(start, start + batch_size)
+        for person in citizens:
+            person['import_id'] = import_id
+        ingest.bulk_insert(citizens)
+    stats.add_histogram(import_id, data.histogram())
+    months = data.birth_dates.astype('datetime64[M]').astype(numpy.int64) % 12 + 1
+    holders = numpy.repeat(numpy.arange(data.count), numpy.diff(data.offsets))
+    presents.add_relations(import_id, months[holders], data.citizen_ids[data.relatives])
+    db.session.commit()
+    return import_id
+
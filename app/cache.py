@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+from threading import Lock
+
+from flask import request, make_response, Response
+
+from app import app
+from app.models import Import
+
+# read-through cache of GET responses of an import
+# response depends only on import data (and current date for ages),
+# so key is (import_id, created_at, version, route[, date][, query string])
+# version is incremented by every PATCH, so stale entries are never served even by other workers
+# ETag is built from the key and If-None-Match is answered before any response is built
+
+
+class MemoryBackend(object):
+    # LRU of response bodies bounded by total size in bytes
+    # any object with the same methods can be used as a backend
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def delete_import(self, import_id: int):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == import_id]:
+                self.size -= len(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class ResponseCache(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        # counters are incremented by request threads
+        self.lock = Lock()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, not_modified=self.not_modified)
+
+    def _count(self, counter: str):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def invalidate(self, import_id: int):
+        # entries of previous versions can not be hit anymore, dropping them to free memory
+        self.backend.delete_import(import_id)
+
+    def cached(self, route: str, daily: bool = False):
+        # decorator for GET routes with import_id argument
+        # daily responses depend on current date (UTC)
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(import_id, **kwargs):
+                if not app.config['RESPONSE_CACHE']:
+                    return view(import_id, **kwargs)
+                current = Import.query.get(import_id)
+                if current is None:
+                    # view responds with an error
+                    return view(import_id, **kwargs)
+
+                key = (import_id, current.created_at.isoformat(), current.version, route)
+                if daily:
+                    key += (datetime.utcnow().date().isoformat(),)
+                if request.query_string:
+                    # pages and projections are cached separately
+                    key += (request.query_string.decode(),)
+                etag = '-'.join(map(str, key))
+                # weak comparison, compressed representations have weak ETag (see app/compress.py)
+                if request.if_none_match.contains_weak(etag):
+                    self._count('not_modified')
+                    response = Response(status=304)
+                    response.set_etag(etag)
+                    return response
+
+                body = self.backend.get(key)
+                if body is not None:
+                    self._count('hits')
+                    response = Response(body, 200, mimetype='application/json')
+                    response.set_etag(etag)
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                self._count('misses')
+                response = make_response(view(import_id, **kwargs))
+                if response.status_code == 200:
+                    response.set_etag(etag)
+                    response.headers['X-Cache'] = 'MISS'
+                    if response.is_streamed:
+                        response.response = self._store_stream(key, response.response)
+                    else:
+                        self.backend.set(key, response.get_data())
+                return response
+            return wrapper
+        return decorator
+
+    def _store_stream(self, key, chunks):
+        # passes chunks through and stores the body once the stream is finished
+        # bodies larger than RESPONSE_CACHE_MAX_ENTRY_BYTES are not collected at all
+        limit = app.config['RESPONSE_CACHE_MAX_ENTRY_BYTES']
+        body = []
+        size = 0
+        for chunk in chunks:
+            if body is not None:
+                body.append(chunk if isinstance(chunk, bytes) else chunk.encode())
+                size += len(body[-1])
+                if size > limit:
+                    body = None
+            yield chunk
+        if body is not None:
+            self.backend.set(key, b''.join(body))
+
+
+response_cache = ResponseCache(MemoryBackend(app.config['RESPONSE_CACHE_MAX_BYTES']))
@@ -0,0 +1,151 @@
+import zlib
+from functools import wraps
+from time import perf_counter
+
+try:
+    import zstandard
+except ImportError:  # only gzip is offered
+    zstandard = None
+
+from flask import request, make_response
+
+from app import app
+from app.cache import response_cache
+
+# content negotiation and compression of large GET responses of imports
+# encoding is picked from Accept-Encoding (zstd if zstandard is installed, gzip otherwise),
+# bodies below COMPRESSION_MIN_BYTES are sent as is
+# streamed bodies are buffered only until the threshold is reached, then compressed chunk by chunk
+# with a flush after every chunk, so the client gets data as it is produced
+#
+# compressed bodies of cacheable responses are kept in the response cache backend under (import_id, etag, encoding),
+# so repeated requests are not compressed again and PATCH drops them together with the plain body
+# compressed responses get weak ETag of the plain one, same as nginx does
+
+
+def encodings() -> list:
+    # supported encodings in order of preference
+    return ['zstd', 'gzip'] if zstandard is not None else ['gzip']
+
+
+def compressor(encoding: str):
+    # returns (compress, finish) functions of a new stream
+    # compress(chunk) returns compressed bytes of everything given so far (flushed block)
+    if encoding == 'zstd':
+        stream = zstandard.ZstdCompressor(level=app.config['COMPRESSION_ZSTD_LEVEL']).compressobj()
+        return (lambda chunk: stream.compress(chunk) + stream.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+                stream.flush)
+    # wbits 31 is gzip container
+    stream = zlib.compressobj(app.config['COMPRESSION_GZIP_LEVEL'], zlib.DEFLATED, 31)
+    return lambda chunk: stream.compress(chunk) + stream.flush(zlib.Z_SYNC_FLUSH), stream.flush
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    compress_chunk, finish = compressor(encoding)
+    return compress_chunk(body) + finish()
+
+
+def compressed(view):
+    # decorator for GET routes with import_id argument, goes above response_cache.cached
+
+    @wraps(view)
+    def wrapper(import_id, **kwargs):
+        response = make_response(view(import_id, **kwargs))
+        if not app.config['COMPRESSION'] or response.status_code != 200 or \
+                'Content-Encoding' in response.headers:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(encodings())
+        if encoding is None:
+            return response
+
+        etag, _ = response.get_etag()
+        key = (import_id, etag, encoding) if etag and app.config['RESPONSE_CACHE'] else None
+        if key is not None:
+            body = response_cache.backend.get(key)
+            if body is not None:
+                response.close()
+                _encoded(response, encoding, etag)
+                response.set_data(body)
+                return response
+
+        if response.is_streamed:
+            head, chunks = _peek(iter(response.response), app.config['COMPRESSION_MIN_BYTES'])
+            if chunks is None:
+                response.set_data(b''.join(head))
+                return response
+            _encoded(response, encoding, etag)
+            response.response = _compress_stream(head, chunks, encoding, key)
+            return response
+
+        plain = response.get_data()
+        if len(plain) < app.config['COMPRESSION_MIN_BYTES']:
+            return response
+        start = perf_counter()
+        body = compress(plain, encoding)
+        _log(encoding, len(plain), len(body), perf_counter() - start)
+        if key is not None:
+            response_cache.backend.set(key, body)
+        _encoded(response, encoding, etag)
+        response.set_data(body)
+        return response
+    return wrapper
+
+
+def _encoded(response, encoding: str, etag: str):
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(etag, weak=True)
+
+
+def _peek(chunks, size: int) -> tuple:
+    # reads chunks until size bytes are collected
+    # returns (read chunks, rest of iterator) or (all chunks, None) if there was less than size bytes
+    head = []
+    read = 0
+    for chunk in chunks:
+        head.append(chunk if isinstance(chunk, bytes) else chunk.encode())
+        read += len(head[-1])
+        if read >= size:
+            return head, chunks
+    return head, None
+
+
+def _compress_stream(head: list, chunks, encoding: str, key):
+    # compressed body is stored in the cache once the stream is finished
+    # unless it is larger than RESPONSE_CACHE_MAX_ENTRY_BYTES
+    compress_chunk, finish = compressor(encoding)
+    limit = app.config['RESPONSE_CACHE_MAX_ENTRY_BYTES']
+    body = [] if key is not None else None
+    size = 0
+    plain = 0
+    elapsed = 0.0
+    for chunk in _chain(head, chunks):
+        plain += len(chunk)
+        start = perf_counter()
+        data = compress_chunk(chunk)
+        elapsed += perf_counter() - start
+        if data:
+            size += len(data)
+            if body is not None:
+                body.append(data)
+                if size > limit:
+                    body = None
+            yield data
+    data = finish()
+    size += len(data)
+    _log(encoding, plain, size, elapsed)
+    if body is not None:
+        body.append(data)
+        response_cache.backend.set(key, b''.join(body))
+    yield data
+
+
+def _chain(head: list, chunks):
+    yield from head
+    for chunk in chunks:
+        yield chunk if isinstance(chunk, bytes) else chunk.encode()
+
+
+def _log(encoding: str, plain: int, encoded: int, elapsed: float):
+    app.logger.debug('Compressed %d bytes to %d with %s in %.3fs', plain, encoded, encoding, elapsed)
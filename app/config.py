@@ -9,6 +9,83 @@ class Config(object):
                               'sqlite:///' + os.path.join(basedir, DATABASE_FILENAME)
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # INFO shows throughput of bulk inserts (rows/s), DEBUG adds compression of responses
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+    # connection pool of every worker process
+    # SQLite connections are tuned in app/connections.py instead, its file databases are not pooled
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    DB_POOL_RECYCLE = 1800  # seconds
+    SQLALCHEMY_ENGINE_OPTIONS = dict(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    ) if SQLALCHEMY_DATABASE_URI.startswith('postgres') else {}
+
+    # GET routes of imports are served by a random read replica, see app/replicas.py
+    # DATABASE_REPLICA_URLS is a comma separated list, no replicas means everything goes to the primary
+    # clients read from the primary for REPLICA_STICKY_SECONDS after their POST or PATCH
+    SQLALCHEMY_REPLICA_URIS = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+    REPLICA_STICKY_SECONDS = 10
+
+    SQLITE_WAL = True  # readers do not block writer and vice versa
+    SQLITE_SYNCHRONOUS = 'NORMAL'  # in WAL mode it is still safe from corruption
+    SQLITE_BUSY_TIMEOUT_MS = 5000
+
+    # POST /imports writes rows with COPY FROM STDIN when database is PostgreSQL
+    # otherwise (or if disabled) with a single executemany insert
+    BULK_INSERT_COPY = True
+
+    # GET /imports/$import_id/citizens response is sent in chunks while rows are fetched
+    # rows are fetched and encoded by batches of STREAM_BATCH_SIZE
+    STREAM_CITIZENS = True
+    STREAM_BATCH_SIZE = 1000
+    # largest page of GET /imports/$import_id/citizens?limit=
+    CITIZENS_PAGE_MAX_LIMIT = 10000
+
+    # PATCH /imports/$import_id/citizens accepts at most PATCH_BATCH_MAX_SIZE citizens in one request
+    PATCH_BATCH_MAX_SIZE = 10000
+
+    # in-process cache of GET responses of imports, see app/cache.py
+    RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', '1') != '0'
+    RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    RESPONSE_CACHE_MAX_ENTRY_BYTES = 16 * 1024 * 1024
+
+    # GET responses of imports from COMPRESSION_MIN_BYTES are compressed when client accepts gzip or zstd,
+    # see app/compress.py (zstd needs zstandard package)
+    COMPRESSION = os.environ.get('COMPRESSION', '1') != '0'
+    COMPRESSION_MIN_BYTES = 4096
+    COMPRESSION_GZIP_LEVEL = 6
+    COMPRESSION_ZSTD_LEVEL = 3
+
+    # POST /imports with "Prefer: respond-async" header is answered with 202 and handled in background
+    # requests above IMPORT_JOB_QUEUE_SIZE queued or running jobs are rejected with 503
+    ASYNC_IMPORTS = True
+    IMPORT_JOB_WORKERS = 2
+    IMPORT_JOB_QUEUE_SIZE = 16
+    IMPORT_SPOOL_DIR = os.environ.get('IMPORT_SPOOL_DIR')  # system temp dir if not set
+
+    # POST /imports bodies from IMPORT_STREAM_MIN_BYTES (and asynchronous imports)
+    # are parsed incrementally and stored by batches of IMPORT_STREAM_BATCH_SIZE citizens
+    IMPORT_STREAM_MIN_BYTES = 4 * 1024 * 1024
+    IMPORT_STREAM_BATCH_SIZE = 1000
+
+    # columnar snapshots of imports used by percentile route, see app/snapshots.py
+    IMPORT_SNAPSHOTS = os.environ.get('IMPORT_SNAPSHOTS', '1') != '0'
+    IMPORT_SNAPSHOTS_MAX_BYTES = 256 * 1024 * 1024
+
+    # per-request timing in Server-Timing header and GET /metrics, see app/metrics.py
+    INSTRUMENTATION = os.environ.get('INSTRUMENTATION', '0') == '1'
+    # cProfile stats of PROFILE_SLOWEST slowest requests are kept (0 disables profiling)
+    # only PROFILE_SAMPLE_RATE of requests run under profiler
+    PROFILE_SLOWEST = int(os.environ.get('PROFILE_SLOWEST', 0))
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 1.0))
+
+    # citizens are encoded with orjson if it is installed, see app/serialize.py
+    FAST_JSON = os.environ.get('FAST_JSON', '1') != '0'
+
     # so response will not have sorted keys
     JSON_SORT_KEYS = False
     # sorting is done in order to ensure that independent of the hash seed of the dictionary
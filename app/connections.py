@@ -0,0 +1,21 @@
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+
+# per connection settings of SQLite databases
+# applied to every engine, so databases switched at runtime (tests, replicas) are tuned as well
+
+
+@event.listens_for(Engine, 'connect')
+def tune_sqlite(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA busy_timeout = {:d}'.format(app.config['SQLITE_BUSY_TIMEOUT_MS']))
+    if app.config['SQLITE_WAL']:
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('PRAGMA synchronous = {}'.format(app.config['SQLITE_SYNCHRONOUS']))
+    cursor.close()
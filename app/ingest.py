@@ -0,0 +1,161 @@
+import csv
+import io
+import pickle
+import tempfile
+import time
+from array import array
+from collections import Counter
+from datetime import datetime
+
+import numpy
+from flask import abort
+from marshmallow import ValidationError
+
+from app import app, db, stats, presents
+from app.jsonstream import ArrayReader, UnknownKey
+from app.models import Citizen, Import, relatives_table
+from app.validate import CitizenSchema, parse_citizen, edges_symmetric, relation_errors
+
+# bulk ingestion of validated imports
+# rows are written with Core inserts instead of one ORM object per citizen
+# so unit-of-work bookkeeping is skipped entirely
+
+CITIZEN_COLUMNS = ('import_id', 'citizen_id', 'town', 'street', 'building',
+                   'apartment', 'name', 'birth_date', 'gender')
+RELATIVES_COLUMNS = ('import_id', 'citizen_id', 'relative_id')
+
+
+def bulk_insert(citizens: list) -> int:
+    # citizens are dicts with already parsed birth_date and import_id set
+    # inserted inside current db.session transaction, so caller decides when to commit
+    # returns number of inserted rows
+    start = time.perf_counter()
+    connection = db.session.connection()
+
+    citizen_rows = []
+    relative_rows = []
+    for person in citizens:
+        citizen_rows.append((person['import_id'], person['citizen_id'], person['town'],
+                             person['street'], person['building'], person['apartment'], person['name'],
+                             person['birth_date'], person['gender']))
+        relative_rows.extend((person['import_id'], person['citizen_id'], relative)
+                             for relative in person['relatives'])
+
+    if connection.dialect.name == 'postgresql' and app.config['BULK_INSERT_COPY']:
+        _copy_insert(connection, Citizen.__tablename__, CITIZEN_COLUMNS, citizen_rows)
+        _copy_insert(connection, relatives_table.name, RELATIVES_COLUMNS, relative_rows)
+    else:
+        # single executemany statement per table
+        # (empty parameters list would mean a single insert of default values)
+        if citizen_rows:
+            connection.execute(Citizen.__table__.insert(),
+                               [dict(zip(CITIZEN_COLUMNS, row)) for row in citizen_rows])
+        if relative_rows:
+            connection.execute(relatives_table.insert(),
+                               [dict(zip(RELATIVES_COLUMNS, row)) for row in relative_rows])
+
+    elapsed = time.perf_counter() - start
+    app.logger.info('Inserted %d citizens and %d relations in %.3fs (%.0f rows/s)',
+                    len(citizen_rows), len(relative_rows), elapsed,
+                    (len(citizen_rows) + len(relative_rows)) / elapsed if elapsed else 0)
+    return len(citizen_rows)
+
+
+def _copy_insert(connection, table_name: str, columns: tuple, rows: list):
+    # PostgreSQL COPY FROM STDIN in csv format
+    # uses raw DBAPI connection of the session, so it is part of the same transaction
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows(rows)
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            table_name, ', '.join(columns)), buffer)
+    finally:
+        cursor.close()
+
+
+def import_stream(stream) -> int:
+    # stores import read incrementally from a binary stream with {"citizens": [...]} document
+    # citizens are validated in batches of IMPORT_STREAM_BATCH_SIZE as they arrive and spooled to a temporary file,
+    # relations are checked at the end
+    # parsed citizens are not held in memory, only compact per-import data grows with the import:
+    # the set of citizen ids, the edge arrays (three int64 per relation) and the birth dates histogram
+    # nothing is written to the database until the whole body is read and valid,
+    # so a slow upload does not hold the write transaction (and the SQLite write lock) open
+    # aborts with 400 if data is invalid, returns new import id
+    batch_size = app.config['IMPORT_STREAM_BATCH_SIZE']
+    reader = ArrayReader(stream, 'citizens')
+    spool_dir = app.config['IMPORT_SPOOL_DIR'] or tempfile.gettempdir()
+
+    now = datetime.utcnow()
+    dates = {}
+    ids = {}  # ordered set of citizen ids
+    # compact edge list, relation i is edge_citizens[i] -> edge_relatives[i]
+    edge_citizens = array('q')
+    edge_relatives = array('q')
+    edge_months = array('q')  # birth month of edge_citizens[i]
+    histogram = Counter()
+
+    def store(spool, batch: list, offset: int):
+        if not batch:
+            return
+        citizens = [parse_citizen(person, now, dates) for person in batch]
+        if None in citizens:
+            try:
+                citizens = CitizenSchema(many=True).load(batch)
+            except ValidationError as e:
+                abort(400, str({'citizens': {offset + index: messages for index, messages in e.messages.items()}}))
+        for person in citizens:
+            citizen_id = person['citizen_id']
+            if citizen_id in ids:
+                abort(400, str({'citizens': ['Citizen ids are not unique.']}))
+            ids[citizen_id] = None
+            edge_citizens.extend([citizen_id] * len(person['relatives']))
+            edge_relatives.extend(person['relatives'])
+            edge_months.extend([person['birth_date'].month] * len(person['relatives']))
+            histogram[person['town'], person['birth_date']] += 1
+        pickle.dump(citizens, spool, pickle.HIGHEST_PROTOCOL)
+
+    with tempfile.TemporaryFile(dir=spool_dir, prefix='import-', suffix='.batches') as spool:
+        batch = []
+        offset = 0
+        try:
+            for person in reader:
+                batch.append(person)
+                if len(batch) == batch_size:
+                    store(spool, batch, offset)
+                    offset += len(batch)
+                    batch = []
+            store(spool, batch, offset)
+        except UnknownKey as e:
+            abort(400, str({e.key: ['Unknown field.']}))
+        except (ValueError, OverflowError) as e:
+            abort(400, 'Failed to decode JSON object: {}'.format(e))
+        if not reader.found:
+            abort(400, str({'citizens': ['Missing data for required field.']}))
+
+        if not edges_symmetric(numpy.frombuffer(edge_citizens, numpy.int64),
+                               numpy.frombuffer(edge_relatives, numpy.int64)):
+            relations = {citizen_id: [] for citizen_id in ids}
+            for citizen_id, relative in zip(edge_citizens, edge_relatives):
+                relations[citizen_id].append(relative)
+            abort(400, '\n'.join(relation_errors(relations)))
+
+        new_import = Import(citizens_count=len(ids))
+        db.session.add(new_import)
+        db.session.flush()
+        import_id = new_import.id
+        spool.seek(0)
+        for _ in range(0, len(ids), batch_size):
+            citizens = pickle.load(spool)
+            for person in citizens:
+                person['import_id'] = import_id
+            bulk_insert(citizens)
+
+    stats.add_histogram(import_id, histogram)
+    presents.add_relations(import_id, numpy.frombuffer(edge_months, numpy.int64),
+                           numpy.frombuffer(edge_relatives, numpy.int64))
+    db.session.commit()
+    return import_id
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Lock, Semaphore
+
+from flask import abort
+from werkzeug.exceptions import HTTPException
+
+from app import app, db
+from app.models import ImportJob
+
+# asynchronous imports
+# request body is spooled to disk and handled by a pool of background threads
+# job state is kept in import_jobs table, so it can be polled through any worker
+
+_lock = Lock()
+_executor = None
+_slots = None
+
+
+def _pool():
+    # pool is started on first asynchronous import
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(app.config['IMPORT_JOB_WORKERS'], thread_name_prefix='import-job')
+            _slots = Semaphore(app.config['IMPORT_JOB_QUEUE_SIZE'])
+    return _executor, _slots
+
+
+def submit(stream, handler) -> ImportJob:
+    # stream is request body, handler(stream) stores import and returns its id
+    # aborts with 503 when too many jobs are queued or running
+    executor, slots = _pool()
+    if not slots.acquire(blocking=False):
+        abort(503, 'Too many imports in progress, retry later.')
+    try:
+        spool_dir = app.config['IMPORT_SPOOL_DIR'] or tempfile.gettempdir()
+        with tempfile.NamedTemporaryFile('wb', dir=spool_dir, prefix='import-', suffix='.json',
+                                         delete=False) as spool:
+            shutil.copyfileobj(stream, spool)
+        job = ImportJob()
+        db.session.add(job)
+        db.session.commit()
+        executor.submit(_run, job.id, spool.name, handler, slots)
+    except BaseException:
+        slots.release()
+        raise
+    return job
+
+
+def _run(job_id: int, path: str, handler, slots):
+    with app.app_context():
+        try:
+            ImportJob.query.filter_by(id=job_id).update({ImportJob.status: 'running'})
+            db.session.commit()
+            try:
+                with open(path, 'rb') as spool:
+                    import_id = handler(spool)
+            except HTTPException as e:
+                db.session.rollback()
+                changes = {ImportJob.status: 'failed', ImportJob.error: e.description}
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Import job %d failed', job_id)
+                changes = {ImportJob.status: 'failed', ImportJob.error: 'Internal error.'}
+            else:
+                changes = {ImportJob.status: 'done', ImportJob.import_id: import_id}
+            changes[ImportJob.finished_at] = datetime.utcnow()
+            ImportJob.query.filter_by(id=job_id).update(changes)
+            db.session.commit()
+        finally:
+            db.session.remove()
+            os.unlink(path)
+            slots.release()
@@ -0,0 +1,99 @@
+import codecs
+import json
+import re
+
+# incremental reader of {"key": [item, item, ...]} documents
+# only one array item is kept in memory at a time, the rest of the document is read by chunks
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class UnknownKey(ValueError):
+    # top-level object has a key other than expected one
+    def __init__(self, key):
+        super().__init__('Unknown key {!r}.'.format(key))
+        self.key = key
+
+
+class ArrayReader(object):
+
+    def __init__(self, stream, key: str, chunk_size: int = 64 * 1024):
+        self.stream = stream
+        self.key = key
+        self.chunk_size = chunk_size
+        self.found = False  # key was present in the document
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _read(self) -> bool:
+        # appends next chunk to the buffer, returns False at the end of stream
+        if self._eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        self._eof = not chunk
+        self._buffer = self._buffer[self._pos:] + self._utf8.decode(chunk, final=self._eof)
+        self._pos = 0
+        return not self._eof
+
+    def _next_char(self) -> str:
+        # skips whitespace and returns next character without consuming it ('' at the end)
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read():
+                return ''
+
+    def _expect(self, chars: str) -> str:
+        char = self._next_char()
+        if not char or char not in chars:
+            raise ValueError('Expected {!r} at position {}.'.format(chars, self._pos))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        # decodes next complete value, reading more data until it fits into the buffer
+        self._next_char()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._read():
+                    raise
+                continue
+            # number at the end of the buffer may continue in the next chunk
+            if end == len(self._buffer) and self._read():
+                continue
+            self._pos = end
+            return value
+
+    def __iter__(self):
+        self._expect('{')
+        if self._next_char() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            if not isinstance(key, str):
+                raise ValueError('Object keys have to be strings.')
+            self._expect(':')
+            if key != self.key:
+                raise UnknownKey(key)
+            if self.found:
+                raise ValueError('Duplicate key {!r}.'.format(key))
+            self.found = True
+            self._expect('[')
+            if self._next_char() == ']':
+                self._pos += 1
+            else:
+                while True:
+                    yield self._value()
+                    if self._expect(',]') == ']':
+                        break
+            if self._expect(',}') == '}':
+                break
+        if self._next_char():
+            raise ValueError('Extra data at position {}.'.format(self._pos))
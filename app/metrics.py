@@ -0,0 +1,230 @@
+import cProfile
+import heapq
+import io
+import pstats
+import random
+from contextlib import contextmanager
+from itertools import count
+from threading import Lock
+from time import perf_counter
+
+from flask import g, request, has_request_context
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+
+# opt-in per-request instrumentation (INSTRUMENTATION config)
+# request time is split into database time (cursor execute), serialization time (JSON encoding) and the rest
+# breakdown of every request is sent in Server-Timing header, totals per route are exposed on GET /metrics
+# with PROFILE_SLOWEST > 0 sampled requests run under cProfile and stats of the slowest ones are kept
+#
+# SQLite executes a SELECT lazily while rows are fetched, so rows fetched after the first one
+# are counted as the rest of request time, not as database time
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestTiming(object):
+    __slots__ = ('start', 'db', 'queries', 'rows', 'serialize', 'status', 'profile')
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.db = 0.0
+        self.queries = 0
+        self.rows = 0
+        self.serialize = 0.0
+        self.status = 500
+        self.profile = None
+
+
+class RouteMetrics(object):
+
+    def __init__(self):
+        self.requests = {}  # status: count
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.duration = 0.0
+        self.db = 0.0
+        self.queries = 0
+        self.rows = 0
+        self.serialize = 0.0
+
+    def add(self, timing: RequestTiming, duration: float):
+        self.requests[timing.status] = self.requests.get(timing.status, 0) + 1
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+        self.duration += duration
+        self.db += timing.db
+        self.queries += timing.queries
+        self.rows += timing.rows
+        self.serialize += timing.serialize
+
+
+_lock = Lock()
+_routes = {}
+_profiles = []  # min-heap of (duration, sequence, description)
+_sequence = count()
+
+
+def current():
+    # timing of the request being handled, None if instrumentation is off or there is no request
+    if not app.config['INSTRUMENTATION'] or not has_request_context():
+        return None
+    return g.get('timing')
+
+
+def add_rows(rows: int):
+    # read paths report rows they have fetched
+    timing = current()
+    if timing is not None:
+        timing.rows += rows
+
+
+@contextmanager
+def serialization():
+    timing = current()
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        if timing is not None:
+            timing.serialize += perf_counter() - start
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    # jsonify() and dicts returned by views are encoded with app.json
+    # bodies built by app/serialize.py are timed there
+
+    def __init__(self, flask_app):
+        super().__init__(flask_app)
+        # config key is ignored since Flask 2.3, the provider keeps key order itself
+        self.sort_keys = flask_app.config['JSON_SORT_KEYS']
+
+    def dumps(self, obj, **kwargs):
+        with serialization():
+            return super().dumps(obj, **kwargs)
+
+
+app.json = TimedJSONProvider(app)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if current() is not None:
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    timing = current()
+    if timing is not None and conn.info.get('query_start'):
+        timing.db += perf_counter() - conn.info['query_start'].pop()
+        timing.queries += 1
+
+
+@app.before_request
+def _start_request():
+    if not app.config['INSTRUMENTATION']:
+        return
+    timing = g.timing = RequestTiming()
+    if app.config['PROFILE_SLOWEST'] and random.random() < app.config['PROFILE_SAMPLE_RATE']:
+        timing.profile = cProfile.Profile()
+        timing.profile.enable()
+
+
+@app.after_request
+def _server_timing(response):
+    timing = current()
+    if timing is None:
+        return response
+    timing.status = response.status_code
+    # streamed bodies are generated after this point, their time is only in /metrics
+    response.headers['Server-Timing'] = \
+        'db;dur={:.3f};desc="{} queries", serialize;dur={:.3f}, total;dur={:.3f}'.format(
+            timing.db * 1000, timing.queries, timing.serialize * 1000, (perf_counter() - timing.start) * 1000)
+    return response
+
+
+@app.teardown_request
+def _finish_request(exception):
+    # called after the response body is sent, including streamed ones
+    timing = current()
+    if timing is None:
+        return
+    duration = perf_counter() - timing.start
+    route = request.endpoint or 'unknown'
+    if timing.profile is not None:
+        timing.profile.disable()
+    with _lock:
+        _routes.setdefault((route, request.method), RouteMetrics()).add(timing, duration)
+        keep = timing.profile is not None and (
+            len(_profiles) < app.config['PROFILE_SLOWEST'] or duration > _profiles[0][0])
+    if keep:
+        stats = io.StringIO()
+        pstats.Stats(timing.profile, stream=stats).sort_stats('cumulative').print_stats(30)
+        description = '{} {} {} {:.3f}s\n{}'.format(request.method, request.full_path.rstrip('?'),
+                                                    timing.status, duration, stats.getvalue())
+        with _lock:
+            heapq.heappush(_profiles, (duration, next(_sequence), description))
+            while len(_profiles) > app.config['PROFILE_SLOWEST']:
+                heapq.heappop(_profiles)
+
+
+def profiles() -> list:
+    # cProfile stats of the slowest sampled requests, slowest first
+    with _lock:
+        return [description for _, _, description in sorted(_profiles, reverse=True)]
+
+
+def reset():
+    with _lock:
+        _routes.clear()
+        _profiles.clear()
+
+
+def prometheus(extra: dict = None) -> str:
+    # metrics in Prometheus text exposition format
+    # extra is {name: value} of additional counters (e.g. response cache stats)
+    with _lock:
+        routes = sorted(_routes.items())
+        lines = []
+
+        def family(name, kind, description, samples):
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.extend(samples)
+
+        def labels(route, method, **more):
+            pairs = [('route', route), ('method', method)] + sorted(more.items())
+            return '{' + ','.join('{}="{}"'.format(key, value) for key, value in pairs) + '}'
+
+        family('app_requests_total', 'counter', 'Handled requests.', [
+            'app_requests_total{} {}'.format(labels(route, method, status=status), requests)
+            for (route, method), metrics in routes for status, requests in sorted(metrics.requests.items())])
+        histogram = []
+        for (route, method), metrics in routes:
+            total = sum(metrics.requests.values())
+            for bound, requests in zip(DURATION_BUCKETS, metrics.buckets):
+                histogram.append('app_request_duration_seconds_bucket{} {}'.format(
+                    labels(route, method, le=bound), requests))
+            histogram.append('app_request_duration_seconds_bucket{} {}'.format(
+                labels(route, method, le='+Inf'), total))
+            histogram.append('app_request_duration_seconds_sum{} {:.6f}'.format(
+                labels(route, method), metrics.duration))
+            histogram.append('app_request_duration_seconds_count{} {}'.format(labels(route, method), total))
+        family('app_request_duration_seconds', 'histogram', 'Request duration including streamed body.',
+               histogram)
+        for name, attribute, description in (
+                ('app_db_seconds_total', 'db', 'Time spent executing SQL statements.'),
+                ('app_db_queries_total', 'queries', 'Executed SQL statements.'),
+                ('app_db_rows_total', 'rows', 'Rows fetched from the database.'),
+                ('app_serialize_seconds_total', 'serialize', 'Time spent encoding JSON.')):
+            family(name, 'counter', description, [
+                '{}{} {}'.format(name, labels(route, method), round(getattr(metrics, attribute), 6))
+                for (route, method), metrics in routes])
+
+    for name, value in sorted((extra or {}).items()):
+        family(name, 'counter', name.replace('_', ' ').capitalize() + '.', ['{} {}'.format(name, value)])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,131 @@
+import pickle
+import sys
+from datetime import datetime
+
+from sqlalchemy import create_engine, inspect, select, text
+
+from app.config import Config
+from app.models import Citizen, Import, ImportJob, town_birth_dates_table, relatives_table, \
+    birthday_presents_table
+from app.presents import aggregation
+
+# converts databases created by older versions of the service
+# every step checks the current schema, so running migration twice is harmless
+#
+#   python3 -m app.migrate [DATABASE_URL]
+
+
+def relatives_to_table(connection):
+    # citizens.relatives PickleType column -> relatives table
+    columns = [c['name'] for c in inspect(connection).get_columns('citizens')]
+    if 'relatives' not in columns:
+        return
+    connection.execute('CREATE TABLE IF NOT EXISTS relatives ('
+                       'import_id INTEGER NOT NULL, '
+                       'citizen_id INTEGER NOT NULL, '
+                       'relative_id INTEGER NOT NULL, '
+                       'PRIMARY KEY (import_id, citizen_id, relative_id))')
+    rows = []
+    for import_id, citizen_id, relatives in connection.execute(
+            'SELECT import_id, citizen_id, relatives FROM citizens'):
+        relatives = pickle.loads(relatives) if relatives else []
+        rows.extend(dict(import_id=import_id, citizen_id=citizen_id, relative_id=relative)
+                    for relative in relatives)
+    if rows:
+        connection.execute(text('INSERT INTO relatives (import_id, citizen_id, relative_id) '
+                                'VALUES (:import_id, :citizen_id, :relative_id)'), rows)
+    connection.execute('ALTER TABLE citizens DROP COLUMN relatives')
+
+
+def natural_primary_key(connection):
+    # citizens.uuid primary key -> (import_id, citizen_id) primary key with supporting indexes
+    # and foreign key to imports (also added to tables converted before it was declared)
+    # constraints can not be altered in place in SQLite, so table is rebuilt
+    # runs after imports_table, so every import_id is already present in imports
+    columns = [c['name'] for c in inspect(connection).get_columns('citizens')]
+    foreign_keys = inspect(connection).get_foreign_keys('citizens')
+    if 'uuid' not in columns and any(key['referred_table'] == 'imports' for key in foreign_keys):
+        return
+    connection.execute('ALTER TABLE citizens RENAME TO citizens_old')
+    if connection.dialect.name == 'postgresql':
+        # constraint keeps its name after rename and would clash with the new one
+        connection.execute('ALTER TABLE citizens_old DROP CONSTRAINT citizens_pkey')
+    connection.execute('CREATE TABLE citizens ('
+                       'import_id INTEGER NOT NULL, '
+                       'citizen_id INTEGER NOT NULL, '
+                       'town VARCHAR, '
+                       'street VARCHAR, '
+                       'building VARCHAR, '
+                       'apartment INTEGER, '
+                       'name VARCHAR, '
+                       'birth_date {}, '
+                       'gender VARCHAR, '
+                       'PRIMARY KEY (import_id, citizen_id), '
+                       'FOREIGN KEY (import_id) REFERENCES imports (id))'.format(
+                           'TIMESTAMP' if connection.dialect.name == 'postgresql' else 'DATETIME'))
+    connection.execute('INSERT INTO citizens '
+                       '(import_id, citizen_id, town, street, building, apartment, name, birth_date, gender) '
+                       'SELECT import_id, citizen_id, town, street, building, apartment, name, birth_date, gender '
+                       'FROM citizens_old')
+    connection.execute('DROP TABLE citizens_old')
+    for index in Citizen.__table__.indexes:
+        index.create(connection)
+
+
+def town_birth_dates(connection):
+    # fills birth dates histogram of imports created before it was introduced
+    town_birth_dates_table.create(connection, checkfirst=True)
+    connection.execute('INSERT INTO town_birth_dates (import_id, town, birth_date, count) '
+                       'SELECT import_id, town, birth_date, count(*) FROM citizens '
+                       'WHERE import_id NOT IN (SELECT DISTINCT import_id FROM town_birth_dates) '
+                       'GROUP BY import_id, town, birth_date')
+
+
+def imports_table(connection):
+    # ids of existing imports are registered in imports table
+    Import.__table__.create(connection, checkfirst=True)
+    # columns without server default are listed explicitly, including ones added by later steps
+    connection.execute(text('INSERT INTO imports (id, created_at, citizens_count, status, version) '
+                            'SELECT import_id, :now, count(*), :status, 0 FROM citizens '
+                            'WHERE import_id NOT IN (SELECT id FROM imports) '
+                            'GROUP BY import_id'), now=datetime.utcnow(), status='done')
+    if connection.dialect.name == 'postgresql':
+        # sequence has to continue after explicitly inserted ids
+        connection.execute("SELECT setval(pg_get_serial_sequence('imports', 'id'), "
+                           "coalesce(max(id), 0) + 1, false) FROM imports")
+
+
+def import_version(connection):
+    columns = [c['name'] for c in inspect(connection).get_columns('imports')]
+    if 'version' not in columns:
+        connection.execute('ALTER TABLE imports ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
+
+def import_jobs_table(connection):
+    ImportJob.__table__.create(connection, checkfirst=True)
+
+
+def birthday_presents(connection):
+    # fills presents table of imports created before it was introduced, with the aggregation of presents.recompute()
+    birthday_presents_table.create(connection, checkfirst=True)
+    filled = select([birthday_presents_table.c.import_id]).distinct()
+    connection.execute(birthday_presents_table.insert().from_select(
+        ['import_id', 'month', 'citizen_id', 'presents'], aggregation(relatives_table.c.import_id.notin_(filled))))
+
+
+MIGRATIONS = [relatives_to_table, imports_table, import_version, natural_primary_key, town_birth_dates,
+              import_jobs_table, birthday_presents]
+
+
+def migrate(database_url: str):
+    engine = create_engine(database_url)
+    if 'citizens' not in inspect(engine).get_table_names():
+        # empty database, db.create_all() creates the current schema
+        return
+    with engine.begin() as connection:
+        for step in MIGRATIONS:
+            step(connection)
+
+
+if __name__ == '__main__':
+    migrate(sys.argv[1] if len(sys.argv) > 1 else Config.SQLALCHEMY_DATABASE_URI)
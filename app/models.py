@@ -1,29 +1,79 @@
-from uuid import uuid1
+from datetime import datetime
+from functools import lru_cache
 
-from app import db
+from app import db, metrics
 from app.config import DATEFORMAT
 
 
+class Import(db.Model):
+    # id allocation and metadata of imports
+    # ids come from the table primary key (a sequence in PostgreSQL), so concurrent imports never share them
+    __tablename__ = 'imports'
+
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    citizens_count = db.Column(db.Integer, nullable=False, default=0)
+    status = db.Column(db.String, nullable=False, default='done')
+    # incremented by every change of import data
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ImportJob(db.Model):
+    # asynchronous POST /imports, see app/jobs.py
+    __tablename__ = 'import_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String, nullable=False, default='queued')  # queued, running, done, failed
+    import_id = db.Column(db.Integer, db.ForeignKey('imports.id'))
+    error = db.Column(db.String)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self) -> dict:
+        return dict(
+            job_id=self.id,
+            status=self.status,
+            import_id=self.import_id,
+            error=self.error,
+            created_at=self.created_at.isoformat(),
+            finished_at=self.finished_at.isoformat() if self.finished_at else None
+        )
+
 
 # Many to many relations
-# relatives_table = db.Table('relation', db.Model.metadata,
-#                            db.Column('uuid1', db.Integer, db.ForeignKey('citizens.uuid'), index=True),
-#                            db.Column('uuid2', db.Integer, db.ForeignKey('citizens.uuid')),
-#                            db.UniqueConstraint('uuid1', 'uuid2', name='unique_relation'))
-#
+# every relation is stored in both directions, so relatives of a citizen
+# are read with a single range scan of the primary key (import_id, citizen_id, relative_id)
+# which also covers the relative_id column
+relatives_table = db.Table('relatives', db.Model.metadata,
+                           db.Column('import_id', db.Integer, primary_key=True),
+                           db.Column('citizen_id', db.Integer, primary_key=True),
+                           db.Column('relative_id', db.Integer, primary_key=True))
 
+# birth dates histogram of every town in an import
+# filled on import and kept up to date by PATCH, so age percentiles are answered without scanning citizens
+# dates are stored instead of ages, since ages change as time goes by
+town_birth_dates_table = db.Table('town_birth_dates', db.Model.metadata,
+                                  db.Column('import_id', db.Integer, primary_key=True),
+                                  db.Column('town', db.String, primary_key=True),
+                                  db.Column('birth_date', db.DateTime, primary_key=True),
+                                  db.Column('count', db.Integer, nullable=False))
 
-def generate_uuid():
-    return str(uuid1())
+# presents every citizen of an import buys in every month, i.e. number of its relatives born in that month
+# filled on import and changed by deltas on PATCH, so birthdays are read with a single range scan of the primary key
+birthday_presents_table = db.Table('birthday_presents', db.Model.metadata,
+                                   db.Column('import_id', db.Integer, primary_key=True),
+                                   db.Column('month', db.Integer, primary_key=True),
+                                   db.Column('citizen_id', db.Integer, primary_key=True),
+                                   db.Column('presents', db.Integer, nullable=False))
 
 
 class Citizen(db.Model):
     __tablename__ = 'citizens'
 
-    uuid = db.Column(db.String(32), primary_key=True, default=generate_uuid)
-
-    citizen_id = db.Column(db.Integer)
-    import_id = db.Column(db.Integer)
+    # natural key: citizen ids are unique inside of an import
+    # import_id leads, so any lookup by import (including max(import_id)) is an index range scan
+    import_id = db.Column(db.Integer, db.ForeignKey('imports.id'), primary_key=True, autoincrement=False)
+    citizen_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
 
     town = db.Column(db.String)
     street = db.Column(db.String)
@@ -33,18 +83,14 @@ class Citizen(db.Model):
     birth_date = db.Column(db.DateTime)
     gender = db.Column(db.String)
 
-    # relatives = db.relationship('Citizen', secondary=relatives_table,
-    #                             primaryjoin=uuid == relatives_table.c.uuid1,
-    #                             secondaryjoin=uuid == relatives_table.c.uuid2,
-    #                             backref='connected')
+    __table_args__ = (
+        db.Index('ix_citizens_import_town', 'import_id', 'town'),
+        db.Index('ix_citizens_import_birth_month', import_id, db.extract('month', birth_date)),
+    )
 
-    # storing relatives as serialized Python list
-    # its much faster to do either than storing relatives as many-to-many relations in database
-    # and works well for any route
-    # really depends on problem but this fits okay
-    relatives = db.Column(db.PickleType)
+    # relatives are kept in relatives_table and loaded set-wise with load_relatives()
 
-    def to_dict(self) -> dict:
+    def to_dict(self, relatives: list) -> dict:
         return dict(
             citizen_id=self.citizen_id,
             town=self.town,
@@ -52,7 +98,31 @@ class Citizen(db.Model):
             building=self.building,
             apartment=self.apartment,
             name=self.name,
-            birth_date=self.birth_date.strftime(DATEFORMAT),
+            birth_date=format_date(self.birth_date),
             gender=self.gender,
-            relatives=self.relatives
+            relatives=relatives
         )
+
+
+@lru_cache(maxsize=64 * 1024)
+def format_date(value: datetime) -> str:
+    # birth dates repeat a lot across citizens, so every one is formatted once
+    return value.strftime(DATEFORMAT)
+
+
+def load_relatives(import_id: int, citizen_id: int = None, citizen_ids=None) -> dict:
+    # returns {citizen_id: [relative_id, ...]} for whole import, a single citizen or a collection of citizens
+    # citizens without relatives are not present in the result
+    query = db.session.query(relatives_table.c.citizen_id, relatives_table.c.relative_id) \
+        .filter(relatives_table.c.import_id == import_id)
+    if citizen_id is not None:
+        query = query.filter(relatives_table.c.citizen_id == citizen_id)
+    if citizen_ids is not None:
+        query = query.filter(relatives_table.c.citizen_id.in_(citizen_ids))
+    relatives = {}
+    rows = 0
+    for cid, relative_id in query.order_by(relatives_table.c.citizen_id, relatives_table.c.relative_id):
+        relatives.setdefault(cid, []).append(relative_id)
+        rows += 1
+    metrics.add_rows(rows)
+    return relatives
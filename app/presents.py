@@ -0,0 +1,138 @@
+from collections import Counter
+
+import numpy
+
+from app import db, metrics
+from app.models import Citizen, relatives_table, birthday_presents_table
+
+# maintenance of birthday_presents_table
+# every relation (buyer, relative) gives one present bought by the relative in the birth month of the buyer,
+# so rows change only when birth date or relatives of someone change and are adjusted by deltas
+# all functions work inside current db.session transaction
+
+table = birthday_presents_table
+
+MONTHS = range(1, 12 + 1)
+
+
+def add_import(import_id: int, citizens: list):
+    # citizens are dicts with parsed birth_date
+    counts = numpy.fromiter((len(person['relatives']) for person in citizens), numpy.int64, len(citizens))
+    months = numpy.repeat(numpy.fromiter((person['birth_date'].month for person in citizens), numpy.int64,
+                                         len(citizens)), counts)
+    relatives = numpy.fromiter((relative for person in citizens for relative in person['relatives']), numpy.int64,
+                               counts.sum())
+    add_relations(import_id, months, relatives)
+
+
+def add_relations(import_id: int, months: numpy.ndarray, relatives: numpy.ndarray):
+    # relation i of a new import is from a citizen born in months[i] to relatives[i]
+    if not len(relatives):
+        return
+    keys, presents = numpy.unique(numpy.stack([months, relatives]), axis=1, return_counts=True)
+    db.session.execute(table.insert(), [
+        dict(import_id=import_id, month=month, citizen_id=citizen_id, presents=count)
+        for month, citizen_id, count in zip(keys[0].tolist(), keys[1].tolist(), presents.tolist())
+    ])
+
+
+def patch(import_id: int, old_months: dict, new_months: dict, old_relatives: dict, new_relatives: dict):
+    # applies changes of citizens given as {citizen_id: birth month} and {citizen_id: set of relatives}
+    # before and after, every dict has all changed citizens, relations are symmetric before and after
+    delta = Counter()
+    moved = {citizen_id for citizen_id in old_months if old_months[citizen_id] != new_months[citizen_id]}
+    # relations of a citizen with changed month move to another month as a whole
+    for citizen_id in moved:
+        for relative in old_relatives[citizen_id]:
+            delta[old_months[citizen_id], relative] -= 1
+        for relative in new_relatives[citizen_id]:
+            delta[new_months[citizen_id], relative] += 1
+
+    # relations changed in both directions, buyers with changed month are counted above
+    removed = set()
+    added = set()
+    for citizen_id in old_relatives:
+        old, new = old_relatives[citizen_id], new_relatives[citizen_id]
+        removed.update(pair for relative in old - new for pair in ((citizen_id, relative), (relative, citizen_id)))
+        added.update(pair for relative in new - old for pair in ((citizen_id, relative), (relative, citizen_id)))
+    buyers = {buyer for buyer, _ in removed | added} - moved
+    months = {citizen_id: month for citizen_id, month in new_months.items() if citizen_id in buyers}
+    unknown = buyers - set(months)
+    if unknown:
+        month = db.extract('month', Citizen.birth_date)
+        # expanding parameter is compiled once instead of a bound parameter per id
+        query = db.session.query(Citizen.citizen_id, month) \
+            .filter(Citizen.import_id == import_id, Citizen.citizen_id.in_(db.bindparam('ids', expanding=True)))
+        months.update((citizen_id, int(value)) for citizen_id, value in query.params(ids=list(unknown)))
+    for buyer, relative in removed:
+        if buyer not in moved:
+            delta[months[buyer], relative] -= 1
+    for buyer, relative in added:
+        if buyer not in moved:
+            delta[months[buyer], relative] += 1
+    apply_delta(import_id, delta)
+
+
+def apply_delta(import_id: int, delta: Counter):
+    # delta is {(month, citizen_id): change of presents}
+    # counters are changed relatively with a single upsert (SQLite 3.24+, PostgreSQL 9.5+),
+    # rows are created when missing and removed when they reach zero
+    delta = {key: value for key, value in delta.items() if value}
+    if not delta:
+        return
+    db.session.execute(db.text(
+        'INSERT INTO {0} (import_id, month, citizen_id, presents) '
+        'VALUES (:import_id, :month, :citizen_id, :presents) '
+        'ON CONFLICT (import_id, month, citizen_id) DO UPDATE SET presents = {0}.presents + excluded.presents'
+        .format(table.name)), [
+        dict(import_id=import_id, month=month, citizen_id=citizen_id, presents=value)
+        for (month, citizen_id), value in delta.items()])
+    # only decreased rows can reach zero, they are looked up by the primary key
+    decreased = [key for key, value in delta.items() if value < 0]
+    if decreased:
+        db.session.execute(table.delete().where(db.and_(
+            table.c.import_id == import_id,
+            table.c.month.in_(db.bindparam('months', expanding=True)),
+            table.c.citizen_id.in_(db.bindparam('citizen_ids', expanding=True)),
+            table.c.presents <= 0)),
+            dict(months=sorted({month for month, _ in decreased}),
+                 citizen_ids=sorted({citizen_id for _, citizen_id in decreased})))
+
+
+def birthdays(import_id: int) -> dict:
+    # response data of GET /imports/$import_id/citizens/birthdays
+    query = db.session.query(table.c.month, table.c.citizen_id, table.c.presents) \
+        .filter(table.c.import_id == import_id) \
+        .order_by(table.c.month, table.c.citizen_id)
+    response = {month: [] for month in MONTHS}
+    rows = 0
+    for month, citizen_id, presents in query:
+        response[month].append({'citizen_id': citizen_id, 'presents': presents})
+        rows += 1
+    metrics.add_rows(rows)
+    return {str(month): presents for month, presents in response.items()}
+
+
+def aggregation(condition):
+    # rows of the table for relations matching condition: (import_id, month, citizen_id, presents)
+    citizens = Citizen.__table__
+    month = db.extract('month', citizens.c.birth_date)
+    return db.select([relatives_table.c.import_id, month.label('month'),
+                      relatives_table.c.relative_id.label('citizen_id'), db.func.count().label('presents')]) \
+        .select_from(relatives_table.join(citizens, db.and_(
+            citizens.c.import_id == relatives_table.c.import_id,
+            citizens.c.citizen_id == relatives_table.c.citizen_id))) \
+        .where(condition) \
+        .group_by(relatives_table.c.import_id, month, relatives_table.c.relative_id)
+
+
+def recompute(import_id: int) -> dict:
+    # same as birthdays(), computed by a single aggregation over relations of the import
+    response = {month: [] for month in MONTHS}
+    query = aggregation(relatives_table.c.import_id == import_id).order_by('month', 'citizen_id')
+    rows = 0
+    for _, month, relative_id, presents in db.session.execute(query):
+        response[int(month)].append({'citizen_id': relative_id, 'presents': presents})
+        rows += 1
+    metrics.add_rows(rows)
+    return {str(month): presents for month, presents in response.items()}
@@ -0,0 +1,88 @@
+import random
+import time
+from threading import Lock
+
+from flask import g, has_app_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, orm
+
+from app import app
+
+# read/write routing of db.session
+# requests of views marked with @reads run all their queries on a random read replica (SQLALCHEMY_REPLICA_URIS),
+# everything else, including flushes, goes to the primary database
+# after a successful write the client gets a cookie scoped to the import path, so for REPLICA_STICKY_SECONDS
+# its reads of that import are served by the primary and it sees its own writes despite replication lag
+
+STICKY_COOKIE = 'primary_until'
+
+_engines = {}
+_lock = Lock()
+
+
+def engine(url: str):
+    # engines of replicas are created on first use and shared by all threads
+    with _lock:
+        if url not in _engines:
+            options = dict(
+                pool_size=app.config['DB_POOL_SIZE'],
+                max_overflow=app.config['DB_MAX_OVERFLOW'],
+                pool_recycle=app.config['DB_POOL_RECYCLE'],
+                pool_pre_ping=True,
+            ) if url.startswith('postgres') else {}
+            _engines[url] = create_engine(url, **options)
+        return _engines[url]
+
+
+def current_replica():
+    # url of the replica chosen for current request or None
+    if not has_app_context():
+        return None
+    return g.get('replica')
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        url = current_replica()
+        if url is not None and not self._flushing:
+            return engine(url)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def reads(view):
+    # marks a read-only view, its requests may be served by a replica
+    view.reads_replica = True
+    return view
+
+
+@app.before_request
+def route_reads():
+    urls = app.config['SQLALCHEMY_REPLICA_URIS']
+    if not urls or request.method not in ('GET', 'HEAD'):
+        return
+    if not getattr(app.view_functions.get(request.endpoint), 'reads_replica', False):
+        return
+    try:
+        if float(request.cookies.get(STICKY_COOKIE, 0)) > time.time():
+            return
+    except ValueError:
+        pass
+    g.replica = random.choice(urls)
+
+
+@app.after_request
+def stick_to_primary(response):
+    if app.config['SQLALCHEMY_REPLICA_URIS'] and request.method in ('POST', 'PATCH') and response.status_code < 400:
+        import_id = (request.view_args or {}).get('import_id')
+        seconds = app.config['REPLICA_STICKY_SECONDS']
+        response.set_cookie(STICKY_COOKIE, '{:.3f}'.format(time.time() + seconds), max_age=seconds,
+                            path='/imports' if import_id is None else '/imports/{}'.format(import_id),
+                            httponly=True)
+    return response
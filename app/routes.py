@@ -1,75 +1,134 @@
 import time
 from datetime import datetime
 
-from flask import request, abort, jsonify
+from flask import request, abort, jsonify, Response, stream_with_context
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from numpy import percentile  # for percentiles
+from marshmallow import ValidationError
 
 from app import app, db
-from app.models import Citizen
+from app.models import Citizen, Import, ImportJob, relatives_table, load_relatives
 from app.config import DATEFORMAT
-from app import validate
+from app import validate, ingest, stats, presents, serialize, jobs, metrics, binary, replicas, compress
+from app.cache import response_cache
+from app.snapshots import snapshots
 from app.validate import InputDataSchema, PatchCitizenSchema
 
 
 @app.route('/imports', methods=['POST'])
 def post_imports():
+    # asynchronous mode is requested with "Prefer: respond-async" header
+    if app.config['ASYNC_IMPORTS'] and 'respond-async' in request.headers.get('Prefer', ''):
+        if not request.is_json:
+            abort(400)
+        job = jobs.submit(request.stream, ingest.import_stream)
+        response = jsonify({'data': {'job_id': job.id}})
+        response.headers['Location'] = '/imports/jobs/{}'.format(job.id)
+        return response, 202
+
+    # large (or chunked) bodies are parsed and stored incrementally
+    if request.is_json and (request.content_length is None or
+                            request.content_length >= app.config['IMPORT_STREAM_MIN_BYTES']):
+        import_id = ingest.import_stream(request.stream)
+        return jsonify({'data': {"import_id": import_id}}), 201
+
+    if not request.json:
+        abort(400)
+    import_id = create_import(request.json)
+    return jsonify({'data': {"import_id": import_id}}), 201
+
+
+def create_import(data) -> int:
+    # validates and stores import, returns its id
+    # aborts with 400 if data is invalid
+
     # first validation
     # fields should have allowed values
     # (no citizen relations validation yet)
-    if not request.json:
-        abort(400)
-    errors = InputDataSchema().validate(request.json)
+    citizens = validate.parse_import(data)
+    if citizens is None:
+        # slow path also coerces values, so citizens have the same types in both cases
+        try:
+            citizens = InputDataSchema().load(data)['citizens']
+        except ValidationError as e:
+            # arguable decision to send information with advices how to structure request right
+            # but i assume the exact route is unknown for anyone beside authorized personnel
+            abort(400, str(e.messages))
 
+    relations = {person['citizen_id']: person['relatives'] for person in citizens}
+
+    # relation validation
+    # ids is unique -- it was checked by validation at the start
+    errors = validate.relation_errors(relations)
     if errors:
-        # arguable decision to send information with advices how to structure request right
-        # but i assume the exact route is unknown for anyone beside authorized personnel
-        abort(400, str(errors))
+        abort(400, '\n'.join(errors))
 
-    # selecting new import id
-    import_id = db.session.query(db.func.max(Citizen.import_id)).scalar()
-    # if there are imports in the table
-    if import_id is not None:
-        import_id += 1
-    else:
-        import_id = 1
-    relations = {}
-    for person in request.json['citizens']:
-        person['birth_date'] = datetime.strptime(person['birth_date'], DATEFORMAT)
+    # new import id is allocated by the database
+    new_import = Import(citizens_count=len(citizens))
+    db.session.add(new_import)
+    db.session.flush()
+    import_id = new_import.id
+    for person in citizens:
         person['import_id'] = import_id
 
-        # person['relatives']
+    # nothing was written before validation passed
+    ingest.bulk_insert(citizens)
+    stats.add_import(import_id, citizens)
+    presents.add_import(import_id, citizens)
+    db.session.commit()
+    return import_id
 
-        citizen = Citizen(**person)
-        db.session.add(citizen)
-        relations[citizen.citizen_id] = citizen.relatives.copy()
 
-    # relation validation
-    # ids is unique -- it was checked by InputDataSchema().validate() at the start
-    try:
-        for citizen, relatives in relations.items():
-            for relative in relatives:
-                if relative == citizen:
-                    abort(400, 'Citizen {} is relatives with himself.'.format(relative))
-                if citizen not in relations[relative]:
-                    abort(400, 'Relation between citizens {} and {} is one-sided.'.format(relative, citizen))
-    except KeyError:
-        abort(400, 'Relations is malformed')
-    # if abort occurs, db.session rollbacks by itself
-    db.session.commit()
+@app.route('/imports/binary', methods=['POST'])
+def post_binary_import():
+    # body is a citizens file made by GET /imports/$import_id/export, see app/binary.py
+    if app.config['ASYNC_IMPORTS'] and 'respond-async' in request.headers.get('Prefer', ''):
+        job = jobs.submit(request.stream, binary.import_stream)
+        response = jsonify({'data': {'job_id': job.id}})
+        response.headers['Location'] = '/imports/jobs/{}'.format(job.id)
+        return response, 202
+    import_id = binary.import_stream(request.stream)
     return jsonify({'data': {"import_id": import_id}}), 201
 
 
+@app.route('/imports/<int:import_id>/export', methods=['GET'])
+@replicas.reads
+def get_export(import_id):
+    if not validate.import_present(import_id):
+        abort(400)
+    response = Response(binary.dump(import_id), 200, mimetype=binary.MIMETYPE)
+    response.headers['Content-Disposition'] = 'attachment; filename=import-{}.citizens'.format(import_id)
+    return response
+
+
+@app.route('/imports/jobs/<int:job_id>', methods=['GET'])
+def get_import_job(job_id):
+    job = ImportJob.query.get(job_id)
+    if job is None:
+        abort(400)
+    return jsonify({'data': job.to_dict()}), 200
+
+
 @app.route('/imports/<int:import_id>/citizens', methods=['GET'])
+@replicas.reads
+@compress.compressed
+@response_cache.cached('citizens')
 def get_import(import_id):
     if not validate.import_present(import_id):
         abort(400)
-    citizens = Citizen.query.filter_by(import_id=import_id)
-    citizens = [c.to_dict() for c in citizens]
-    return {'data': citizens}, 200
+    try:
+        fields, after, limit = validate.parse_citizens_query(request.args, app.config['CITIZENS_PAGE_MAX_LIMIT'])
+    except ValueError as e:
+        abort(400, str(e))
+    chunks = serialize.citizens_json(import_id, fields, after, limit)
+    if app.config['STREAM_CITIZENS']:
+        return Response(stream_with_context(chunks), 200, mimetype='application/json')
+    return Response(b''.join(chunks), 200, mimetype='application/json')
 
 
 @app.route('/imports/<int:import_id>/citizens/birthdays', methods=['GET'])
+@replicas.reads
+@compress.compressed
+@response_cache.cached('birthdays')
 def get_birthdays(import_id):
     if not validate.import_present(import_id):
         abort(400)
@@ -103,49 +162,25 @@ def get_birthdays(import_id):
     #            }
     #        }, 200
 
-    response = {}
-    months = list(range(1, 12 + 1))
-    import_query = db.session.query(Citizen).filter_by(import_id=import_id)
-    for month in months:
-        month_query = import_query.filter(db.extract('month', Citizen.birth_date) == month)
-        month_count = {}
-        for citizen in month_query:
-            for relative in citizen.relatives:
-                if relative in month_count:
-                    month_count[relative] += 1
-                else:
-                    month_count[relative] = 1
-        response[str(month)] = [{'citizen_id': cid, 'presents': val} for cid, val in month_count.items()]
-    return {'data': response}, 200
+    # presents table is kept up to date on import and PATCH, see app/presents.py
+    return {'data': presents.birthdays(import_id)}, 200
 
 
 @app.route('/imports/<int:import_id>/towns/stat/percentile/age', methods=['GET'])
+@replicas.reads
+@compress.compressed
+@response_cache.cached('percentile', daily=True)
 def get_percentile(import_id):
     if not validate.import_present(import_id):
         abort(400)
 
-    # returns list of sqlalch.results of all distinct towns
-    towns = db.session.query(Citizen.town).filter_by(import_id=import_id).distinct()
-    # converting results to string representation
-    towns = [elem.town for elem in towns]
-
-    dates_query = db.session.query(Citizen.birth_date).filter_by(import_id=import_id)
-    response = []
-    for town in towns:
-        bdays_by_town = dates_query.filter_by(town=town)
-
-        def calculate_age(born: datetime) -> int:
-            # returns age in years
-            today = datetime.utcnow()
-            return today.year - born.year - ((today.month, today.day) < (born.month, born.day))
-
-        ages = [calculate_age(elem.birth_date) for elem in bdays_by_town]
-        response.append({
-            'town': town,
-            'p50': round(percentile(ages, 50, interpolation='linear'), 2),
-            'p75': round(percentile(ages, 75, interpolation='linear'), 2),
-            'p99': round(percentile(ages, 99, interpolation='linear'), 2),
-        })
+    snapshot = snapshots.get(import_id)
+    if snapshot is not None:
+        return jsonify({'data': snapshot.age_percentiles()}), 200
+
+    # birth dates histogram is maintained on import and PATCH
+    # so citizens table is not scanned
+    response = stats.age_percentiles(*stats.town_birth_dates(import_id))
     return jsonify({'data': response}), 200
 
 
@@ -162,6 +197,10 @@ def patch_modify(import_id, citizen_id):
     try:
         mod_citizen = Citizen.query.filter_by(import_id=import_id, citizen_id=citizen_id).one()
         mod_citizen_id = citizen_id
+        old_bucket = (mod_citizen.town, mod_citizen.birth_date)
+        old_relatives = None
+        if 'birth_date' in changes or 'relatives' in changes:
+            old_relatives = set(load_relatives(import_id, citizen_id).get(citizen_id, []))
 
         for field, val in changes.items():
             if field == 'birth_date':
@@ -170,32 +209,41 @@ def patch_modify(import_id, citizen_id):
                 if citizen_id in changes['relatives']:
                     raise ValueError('Citizen {} is relatives with himself.'.format(citizen_id))
 
-                disconnect_persons = set(mod_citizen.relatives) \
-                                     - set(changes['relatives'])
-                connect_persons = set(changes['relatives']) \
-                                  - set(mod_citizen.relatives)
-                for person_id in disconnect_persons:
-                    person = Citizen.query.filter_by(import_id=import_id, citizen_id=person_id).one()
-                    # workaround so orm will detect changes in python list
-                    rel = person.relatives.copy()
-                    rel.remove(mod_citizen_id)
-                    person.relatives = rel
-                for person_id in connect_persons:
-                    person = Citizen.query.filter_by(import_id=import_id, citizen_id=person_id).one()
-                    rel = person.relatives.copy()
-                    rel.append(mod_citizen_id)
-                    person.relatives = rel
-
-                mod_citizen.relatives = changes['relatives']
-                # changes['relatives'] has no incorrect values since
-                # new values were checked during queries
-
-                # mod_citizen.relatives.clear()
-                # for person_id in changes['relatives']:
-                #     person = Citizen.query.filter_by(import_id=import_id, citizen_id=person_id).one()
-                #     mod_citizen.relatives.append(person)
+                current_relatives = old_relatives
+                disconnect_persons = current_relatives - set(changes['relatives'])
+                connect_persons = set(changes['relatives']) - current_relatives
+                # new relatives have to be present in the import, checked with a single query
+                present = db.session.query(Citizen.citizen_id) \
+                    .filter(Citizen.import_id == import_id, Citizen.citizen_id.in_(connect_persons))
+                missing = connect_persons - {person_id for person_id, in present}
+                if missing:
+                    raise ValueError('Citizens {} are not present in import {}.'.format(
+                        ', '.join(map(str, sorted(missing))), import_id))
+
+                # relations are symmetric, so both directions are changed
+                if disconnect_persons:
+                    db.session.execute(relatives_table.delete().where(db.and_(
+                        relatives_table.c.import_id == import_id,
+                        db.or_(db.and_(relatives_table.c.citizen_id == mod_citizen_id,
+                                       relatives_table.c.relative_id.in_(disconnect_persons)),
+                               db.and_(relatives_table.c.citizen_id.in_(disconnect_persons),
+                                       relatives_table.c.relative_id == mod_citizen_id)))))
+                if connect_persons:
+                    db.session.execute(relatives_table.insert(), [
+                        row for person_id in connect_persons for row in (
+                            dict(import_id=import_id, citizen_id=mod_citizen_id, relative_id=person_id),
+                            dict(import_id=import_id, citizen_id=person_id, relative_id=mod_citizen_id))
+                    ])
             else:
                 setattr(mod_citizen, field, val)
+        stats.move_citizen(import_id, old_bucket, (mod_citizen.town, mod_citizen.birth_date))
+        if old_relatives is not None:
+            new_relatives = set(changes['relatives']) if 'relatives' in changes else old_relatives
+            presents.patch(import_id, {citizen_id: old_bucket[1].month}, {citizen_id: mod_citizen.birth_date.month},
+                           {citizen_id: old_relatives}, {citizen_id: new_relatives})
+        Import.query.filter_by(id=import_id).update({Import.version: Import.version + 1})
+        # row is locked by the update, so this is the version made by this PATCH
+        version = db.session.query(Import.version).filter_by(id=import_id).scalar()
 
     except (MultipleResultsFound, NoResultFound, ValueError) as e:
         # Results except when query is malformed
@@ -203,4 +251,140 @@ def patch_modify(import_id, citizen_id):
         abort(400, str(e))
     else:
         db.session.commit()
-        return jsonify({'data': mod_citizen.to_dict()}), 200
+        response_cache.invalidate(import_id)
+        relatives = load_relatives(import_id, citizen_id).get(citizen_id, [])
+        snapshots.patch(import_id, version, citizen_id, mod_citizen.town, mod_citizen.birth_date)
+        return Response(serialize.dumps({'data': mod_citizen.to_dict(relatives)}), 200, mimetype='application/json')
+
+
+@app.route('/imports/<int:import_id>/citizens', methods=['PATCH'])
+def patch_citizens(import_id):
+    # batch of PATCH /imports/$import_id/citizens/$citizen_id in one transaction
+    # body is {"citizens": [{"citizen_id": 1, "changes": {...}}, ...]}, every citizen appears once
+    # changes are applied in order, the whole batch is rejected if any of them is invalid
+    if not validate.import_present(import_id):
+        abort(400)
+    if not request.json:
+        abort(400)
+    edits = request.json.get('citizens') if type(request.json) is dict else None
+    if type(edits) is not list or not edits:
+        abort(400, str({'citizens': ['Non-empty list is required.']}))
+    if len(edits) > app.config['PATCH_BATCH_MAX_SIZE']:
+        abort(400, str({'citizens': ['At most {} citizens are allowed.'.format(app.config['PATCH_BATCH_MAX_SIZE'])]}))
+
+    schema = PatchCitizenSchema(partial=True)
+    errors = {}
+    for index, edit in enumerate(edits):
+        if type(edit) is not dict or edit.keys() != {'citizen_id', 'changes'} or \
+                type(edit['citizen_id']) is not int or type(edit['changes']) is not dict or not edit['changes']:
+            errors[index] = ['Item has to be {"citizen_id": int, "changes": {...}} with some changes.']
+            continue
+        messages = schema.validate(edit['changes'])
+        if messages:
+            errors[index] = messages
+    if errors:
+        abort(400, str({'citizens': errors}))
+    citizen_ids = [edit['citizen_id'] for edit in edits]
+    if len(set(citizen_ids)) != len(citizen_ids):
+        abort(400, str({'citizens': ['Citizen ids are not unique.']}))
+
+    try:
+        citizens = apply_changes(import_id, edits)
+        Import.query.filter_by(id=import_id).update({Import.version: Import.version + 1})
+    except ValueError as e:
+        db.session.rollback()
+        abort(400, str(e))
+    db.session.commit()
+    # snapshot of the import is a version behind now and is rebuilt on next access
+    response_cache.invalidate(import_id)
+    return Response(serialize.dumps({'data': citizens}), 200, mimetype='application/json')
+
+
+def apply_changes(import_id: int, edits: list) -> list:
+    # applies validated changes inside current transaction, returns changed citizens as dicts
+    # raises ValueError describing every unknown citizen or relative
+    citizen_ids = [edit['citizen_id'] for edit in edits]
+    citizens = {person.citizen_id: person for person in
+                Citizen.query.filter(Citizen.import_id == import_id, Citizen.citizen_id.in_(citizen_ids))}
+    missing = [citizen_id for citizen_id in citizen_ids if citizen_id not in citizens]
+    if missing:
+        raise ValueError('Citizens {} are not present in import {}.'.format(', '.join(map(str, missing)), import_id))
+    old_buckets = {citizen_id: (person.town, person.birth_date) for citizen_id, person in citizens.items()}
+
+    # relatives of every citizen of the batch, kept symmetric while changes are applied
+    original = {citizen_id: set(relatives) for citizen_id, relatives in
+                load_relatives(import_id, citizen_ids=citizen_ids).items()}
+    relatives = {citizen_id: set(original.get(citizen_id, ())) for citizen_id in citizen_ids}
+    errors = []
+    for edit in edits:
+        citizen_id = edit['citizen_id']
+        person = citizens[citizen_id]
+        for field, val in edit['changes'].items():
+            if field == 'birth_date':
+                person.birth_date = datetime.strptime(val, DATEFORMAT)
+            elif field == 'relatives':
+                if citizen_id in val:
+                    errors.append('Citizen {} is relatives with himself.'.format(citizen_id))
+                new = set(val)
+                for other in relatives[citizen_id] - new:
+                    if other in relatives:
+                        relatives[other].discard(citizen_id)
+                for other in new - relatives[citizen_id]:
+                    if other in relatives:
+                        relatives[other].add(citizen_id)
+                relatives[citizen_id] = new
+            else:
+                setattr(person, field, val)
+
+    # new relatives have to be present in the import, checked with a single query
+    connected = {other for citizen_id, current in relatives.items()
+                 for other in current - original.get(citizen_id, set())} - set(citizens)
+    present = db.session.query(Citizen.citizen_id) \
+        .filter(Citizen.import_id == import_id, Citizen.citizen_id.in_(connected))
+    missing = connected - {person_id for person_id, in present}
+    if missing:
+        errors.append('Citizens {} are not present in import {}.'.format(
+            ', '.join(map(str, sorted(missing))), import_id))
+    if errors:
+        raise ValueError('\n'.join(errors))
+
+    # relations are symmetric, so both directions are changed
+    removed = set()
+    added = set()
+    for citizen_id, current in relatives.items():
+        old = original.get(citizen_id, set())
+        removed.update(pair for other in old - current for pair in ((citizen_id, other), (other, citizen_id)))
+        added.update(pair for other in current - old for pair in ((citizen_id, other), (other, citizen_id)))
+    if removed:
+        db.session.execute(relatives_table.delete().where(db.and_(
+            relatives_table.c.import_id == import_id,
+            relatives_table.c.citizen_id == db.bindparam('holder'),
+            relatives_table.c.relative_id == db.bindparam('relative'))),
+            [dict(holder=holder, relative=relative) for holder, relative in removed])
+    if added:
+        db.session.execute(relatives_table.insert(), [
+            dict(import_id=import_id, citizen_id=holder, relative_id=relative) for holder, relative in added])
+
+    for citizen_id, person in citizens.items():
+        stats.move_citizen(import_id, old_buckets[citizen_id], (person.town, person.birth_date))
+    presents.patch(import_id,
+                   {citizen_id: birth_date.month for citizen_id, (_, birth_date) in old_buckets.items()},
+                   {citizen_id: person.birth_date.month for citizen_id, person in citizens.items()},
+                   {citizen_id: original.get(citizen_id, set()) for citizen_id in citizen_ids}, relatives)
+    return [citizens[citizen_id].to_dict(sorted(relatives[citizen_id])) for citizen_id in citizen_ids]
+
+
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify({'data': response_cache.stats()}), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    cache = {'app_response_cache_{}_total'.format(name): value for name, value in response_cache.stats().items()}
+    return Response(metrics.prometheus(cache), 200, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics/profiles', methods=['GET'])
+def get_profiles():
+    return Response('\n\n'.join(metrics.profiles()), 200, mimetype='text/plain')
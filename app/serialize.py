@@ -0,0 +1,130 @@
+import json
+from itertools import groupby
+
+try:
+    import orjson
+except ImportError:  # stdlib encoder is used
+    orjson = None
+
+from app import app, db, metrics
+from app.models import Citizen, relatives_table, format_date
+
+# column-only serialization of citizens
+# rows are read with server-side cursors and encoded batch by batch,
+# so memory does not depend on import size
+# orjson is used when installed (and FAST_JSON is on), it writes non-ASCII characters as UTF-8
+# whatever JSON_AS_ASCII is, both encoders keep key order of the dicts
+
+# keys of a citizen in response order, any subset of them can be requested with ?fields=
+FIELDS = ('citizen_id', 'town', 'street', 'building', 'apartment', 'name', 'birth_date', 'gender', 'relatives')
+CITIZEN_COLUMNS = {name: getattr(Citizen, name) for name in FIELDS[:-1]}
+
+
+def iter_rows(import_id: int, fields=FIELDS, after: int = None, limit: int = None):
+    # yields (citizen_id, citizen) with only given fields in the citizen dict (in FIELDS order)
+    # for citizens with citizen_id above after, at most limit of them
+    # only selected columns are read, relations are not queried at all unless relatives are requested
+    # both queries are ordered by citizen_id, so relatives are merged in one pass
+    batch_size = app.config['STREAM_BATCH_SIZE']
+    names = [name for name in FIELDS[:-1] if name in fields]
+    citizens = db.session.query(Citizen.citizen_id, *(CITIZEN_COLUMNS[name] for name in names)) \
+        .filter(Citizen.import_id == import_id)
+    if after is not None:
+        citizens = citizens.filter(Citizen.citizen_id > after)
+    citizens = citizens.order_by(Citizen.citizen_id)
+    # a page is small, so it is fetched at once and bounds the relations query
+    citizens = citizens.limit(limit).all() if limit is not None else citizens.yield_per(batch_size)
+
+    relations = iter(())
+    if 'relatives' in fields and (limit is None or citizens):
+        relations = db.session.query(relatives_table.c.citizen_id, relatives_table.c.relative_id) \
+            .filter(relatives_table.c.import_id == import_id)
+        if after is not None:
+            relations = relations.filter(relatives_table.c.citizen_id > after)
+        if limit is not None:
+            relations = relations.filter(relatives_table.c.citizen_id <= citizens[-1][0])
+        relations = relations.order_by(relatives_table.c.citizen_id, relatives_table.c.relative_id) \
+            .yield_per(batch_size)
+    relations = groupby(relations, key=lambda row: row[0])
+
+    with_relatives = 'relatives' in fields
+    date_index = names.index('birth_date') + 1 if 'birth_date' in names else None
+    next_id, next_relatives = next(relations, (None, None))
+    rows = 0
+    for row in citizens:
+        citizen_id = row[0]
+        citizen = dict(zip(names, row[1:]))
+        if date_index is not None:
+            citizen['birth_date'] = format_date(row[date_index])
+        rows += 1
+        if with_relatives:
+            relatives = []
+            if next_id == citizen_id:
+                relatives = [relative_id for _, relative_id in next_relatives]
+                next_id, next_relatives = next(relations, (None, None))
+            citizen['relatives'] = relatives
+            rows += len(relatives)
+        yield citizen_id, citizen
+    metrics.add_rows(rows)
+
+
+def fast_json() -> bool:
+    return orjson is not None and app.config['FAST_JSON']
+
+
+def ensure_ascii() -> bool:
+    # JSON_AS_ASCII is unset by default (and gone in Flask 2.3), non-ASCII characters are written as UTF-8 then
+    return bool(app.config.get('JSON_AS_ASCII'))
+
+
+def dumps(data) -> bytes:
+    # compact JSON document equivalent to jsonify() body, but not byte for byte:
+    # non-ASCII characters are written as UTF-8 (escaped by the stdlib encoder only if JSON_AS_ASCII is set),
+    # while jsonify() escapes them by default, so bytes and ETags of both may differ
+    with metrics.serialization():
+        if fast_json():
+            return orjson.dumps(data) + b'\n'
+        return (json.dumps(data, ensure_ascii=ensure_ascii(), separators=(',', ':')) + '\n').encode()
+
+
+def batch_encoder():
+    # returns function encoding a list of dicts as comma separated JSON objects
+    if fast_json():
+        return lambda batch: orjson.dumps(batch)[1:-1]
+    encoder = json.JSONEncoder(ensure_ascii=ensure_ascii(), separators=(',', ':'))
+    return lambda batch: ','.join(map(encoder.encode, batch)).encode()
+
+
+def citizens_json(import_id: int, fields=FIELDS, after: int = None, limit: int = None):
+    # yields {"data": [...]} document in chunks of bytes
+    # the opening bracket goes out before queries are executed
+    # with limit the document is a page {"data": [...], "next": citizen_id}, where next is the value of
+    # after for the following page or null for the last one
+    encode = batch_encoder()
+    batch_size = app.config['STREAM_BATCH_SIZE']
+    yield b'{"data":['
+    batch = []
+    separator = b''
+    last_id = None
+    count = 0
+    for citizen_id, citizen in iter_rows(import_id, fields, after, None if limit is None else limit + 1):
+        count += 1
+        if limit is not None and count > limit:
+            # one more citizen is fetched only to know if there is a next page
+            continue
+        last_id = citizen_id
+        batch.append(citizen)
+        if len(batch) == batch_size:
+            with metrics.serialization():
+                chunk = separator + encode(batch)
+            yield chunk
+            separator = b','
+            batch = []
+    if batch:
+        with metrics.serialization():
+            chunk = separator + encode(batch)
+        yield chunk
+    if limit is None:
+        yield b']}\n'
+    else:
+        yield b'],"next":' + (str(last_id) if count > limit else 'null').encode() + b'}\n'
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+from threading import Lock
+
+import numpy
+
+from app import app, db, metrics, stats
+from app.models import Citizen, Import
+
+# columnar in-memory snapshots of imports for analytics routes
+# a snapshot is built on first access and is valid for (created_at, version) of the import,
+# so snapshots of other workers are rebuilt after PATCH, while the worker handling PATCH patches its one in place
+#
+# citizens are kept sorted by citizen_id, every column is indexed by position in citizen_ids
+# relations are not kept, birthdays are served from the presents table (see app/presents.py)
+
+
+class Snapshot(object):
+
+    def __init__(self, created_at, version: int, citizen_ids, town_names: list, towns, birth_dates):
+        self.created_at = created_at
+        self.version = version
+        self.citizen_ids = citizen_ids  # int64, sorted
+        self.town_names = town_names  # town_names[code] is the name, codes of new towns are appended
+        self.town_codes = {name: code for code, name in enumerate(town_names)}
+        self.towns = towns  # int32 codes
+        self.birth_dates = birth_dates  # datetime64[D], i.e. ordinal days
+        self.lock = Lock()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in (self.citizen_ids, self.towns, self.birth_dates)) + \
+            sum(len(name) for name in self.town_names)
+
+    def age_percentiles(self) -> list:
+        # response data of GET /imports/$import_id/towns/stat/percentile/age
+        with self.lock:
+            return stats.coded_age_percentiles(self.town_names, self.towns, self.birth_dates)
+
+    def patch(self, version: int, citizen_id: int, town: str, birth_date):
+        # applies PATCH of a citizen
+        with self.lock:
+            position = numpy.searchsorted(self.citizen_ids, citizen_id)
+            if town not in self.town_codes:
+                self.town_codes[town] = len(self.town_names)
+                self.town_names.append(town)
+            self.towns[position] = self.town_codes[town]
+            self.birth_dates[position] = numpy.datetime64(birth_date, 'D')
+            self.version = version
+
+
+def build(current: Import) -> Snapshot:
+    citizens = db.session.query(Citizen.citizen_id, Citizen.town, Citizen.birth_date) \
+        .filter(Citizen.import_id == current.id) \
+        .order_by(Citizen.citizen_id) \
+        .all()
+    metrics.add_rows(len(citizens))
+
+    citizen_ids = numpy.array([row[0] for row in citizens], dtype=numpy.int64)
+    town_names, towns = numpy.unique(numpy.array([row[1] for row in citizens], dtype=object),
+                                     return_inverse=True)
+    birth_dates = numpy.array([row[2] for row in citizens], dtype='datetime64[D]')
+    return Snapshot(current.created_at, current.version, citizen_ids, list(town_names), towns.astype(numpy.int32),
+                    birth_dates)
+
+
+class SnapshotStore(object):
+    # LRU of snapshots bounded by total size of their arrays
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()  # import_id: snapshot
+        self.lock = Lock()
+
+    def get(self, import_id: int):
+        # returns up to date snapshot of the import, None if snapshots are disabled or import is not present
+        if not app.config['IMPORT_SNAPSHOTS']:
+            return None
+        current = Import.query.get(import_id)
+        if current is None:
+            return None
+        with self.lock:
+            snapshot = self.entries.get(import_id)
+            if snapshot is not None:
+                self.entries.move_to_end(import_id)
+        if snapshot is not None and (snapshot.created_at, snapshot.version) == (current.created_at, current.version):
+            return snapshot
+
+        snapshot = build(current)
+        self._put(import_id, snapshot)
+        return snapshot
+
+    def _put(self, import_id: int, snapshot: Snapshot):
+        size = snapshot.nbytes
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if import_id in self.entries:
+                self.size -= self.entries.pop(import_id).nbytes
+            self.entries[import_id] = snapshot
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes
+
+    def patch(self, import_id: int, version: int, citizen_id: int, town: str, birth_date):
+        # version is the import version after PATCH
+        # snapshot is patched only if it is exactly one version behind, otherwise it is rebuilt on next access
+        with self.lock:
+            snapshot = self.entries.get(import_id)
+            if snapshot is None:
+                return
+            self.size -= snapshot.nbytes
+            if snapshot.version != version - 1:
+                del self.entries[import_id]
+                return
+            snapshot.patch(version, citizen_id, town, birth_date)
+            self.size += snapshot.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+snapshots = SnapshotStore(app.config['IMPORT_SNAPSHOTS_MAX_BYTES'])
@@ -0,0 +1,102 @@
+from collections import Counter
+from datetime import date, datetime
+
+import numpy
+
+from app import db, metrics
+from app.models import town_birth_dates_table
+
+# maintenance of town_birth_dates_table
+# both functions work inside current db.session transaction
+
+table = town_birth_dates_table
+
+# linear interpolation, same as numpy default
+PERCENTILES = [50, 75, 99]
+
+
+def add_import(import_id: int, citizens: list):
+    # citizens are dicts with parsed birth_date
+    add_histogram(import_id, Counter((person['town'], person['birth_date']) for person in citizens))
+
+
+def add_histogram(import_id: int, histogram: Counter):
+    # histogram is {(town, birth_date): count} of a new import
+    if histogram:
+        db.session.execute(table.insert(), [
+            dict(import_id=import_id, town=town, birth_date=birth_date, count=count)
+            for (town, birth_date), count in histogram.items()
+        ])
+
+
+def move_citizen(import_id: int, old: tuple, new: tuple):
+    # citizen moved from (town, birth_date) bucket to another one
+    if old == new:
+        return
+    old_town, old_date = old
+    new_town, new_date = new
+    old_bucket = db.and_(table.c.import_id == import_id, table.c.town == old_town, table.c.birth_date == old_date)
+    db.session.execute(table.update().where(old_bucket).values(count=table.c.count - 1))
+    db.session.execute(table.delete().where(db.and_(old_bucket, table.c.count <= 0)))
+
+    new_bucket = db.and_(table.c.import_id == import_id, table.c.town == new_town, table.c.birth_date == new_date)
+    updated = db.session.execute(table.update().where(new_bucket).values(count=table.c.count + 1))
+    if not updated.rowcount:
+        db.session.execute(table.insert().values(import_id=import_id, town=new_town, birth_date=new_date, count=1))
+
+
+def town_birth_dates(import_id: int) -> tuple:
+    # returns (towns, birth_dates, counts) of the import histogram, sorted by town and date
+    query = db.session.query(table.c.town, table.c.birth_date, table.c.count) \
+        .filter(table.c.import_id == import_id) \
+        .order_by(table.c.town, table.c.birth_date)
+    rows = query.all()
+    metrics.add_rows(len(rows))
+    if not rows:
+        return [], [], []
+    towns, birth_dates, counts = zip(*rows)
+    return towns, birth_dates, counts
+
+
+def calculate_ages(birth_dates: numpy.ndarray, today: date) -> numpy.ndarray:
+    # vectorized age in full years for datetime64[D] array
+    years = birth_dates.astype('datetime64[Y]').astype(int) + 1970
+    months = birth_dates.astype('datetime64[M]')
+    month_day = (months.astype(int) % 12 + 1) * 100 + (birth_dates - months).astype(int) + 1
+    return today.year - years - ((today.month * 100 + today.day) < month_day)
+
+
+def age_percentiles(towns, birth_dates, counts, today: date = None) -> list:
+    # p50, p75 and p99 of ages for every town
+    # birth_dates[i] is shared by counts[i] citizens of towns[i]
+    if not len(towns):
+        return []
+    town_names, town_codes = numpy.unique(numpy.asarray(towns, dtype=object), return_inverse=True)
+    return coded_age_percentiles(town_names, town_codes, birth_dates, counts, today)
+
+
+def coded_age_percentiles(town_names, town_codes, birth_dates, counts=None, today: date = None) -> list:
+    # same as age_percentiles() for towns given as codes, town_names[code] is the name
+    # every date is a single citizen if counts is None
+    if today is None:
+        today = datetime.utcnow().date()
+    if not len(town_codes):
+        return []
+    town_codes = numpy.asarray(town_codes)
+    ages = calculate_ages(numpy.asarray(birth_dates, dtype='datetime64[D]'), today)
+
+    # grouping by town with a single sort
+    order = numpy.argsort(town_codes, kind='stable')
+    bounds = numpy.flatnonzero(numpy.diff(town_codes[order])) + 1
+    response = []
+    for group in numpy.split(order, bounds):
+        group_ages = ages[group] if counts is None else numpy.repeat(ages[group], numpy.asarray(counts)[group])
+        p50, p75, p99 = numpy.percentile(group_ages, PERCENTILES)
+        response.append({
+            'town': town_names[town_codes[group[0]]],
+            'p50': round(p50, 2),
+            'p75': round(p75, 2),
+            'p99': round(p99, 2),
+        })
+    response.sort(key=lambda item: item['town'])
+    return response
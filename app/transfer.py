@@ -0,0 +1,60 @@
+import argparse
+import sys
+
+import numpy
+
+from app import app
+from app.binary import CitizenFile, dump, store
+from app.models import Import
+
+# moves imports between databases as citizens files, see app/binary.py
+# database is taken from DATABASE_URL as by the service itself
+#
+#   python3 -m app.transfer export IMPORT_ID FILE
+#   python3 -m app.transfer import FILE
+#   python3 -m app.transfer info FILE
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m app.transfer')
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export', help='write import to a citizens file')
+    export_parser.add_argument('import_id', type=int)
+    export_parser.add_argument('file')
+    import_parser = commands.add_parser('import', help='store citizens file as a new import')
+    import_parser.add_argument('file')
+    info_parser = commands.add_parser('info', help='check citizens file and print its summary')
+    info_parser.add_argument('file')
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.command == 'export':
+            if Import.query.get(args.import_id) is None:
+                sys.exit('Import {} is not present.'.format(args.import_id))
+            with open(args.file, 'wb') as f:
+                f.writelines(dump(args.import_id))
+        elif args.command == 'import':
+            with open(args.file, 'rb') as f:
+                try:
+                    data = CitizenFile.open(f)
+                    data.validate()
+                except ValueError as e:
+                    sys.exit(str(e))
+            with data:
+                print(store(data))
+        elif args.command == 'info':
+            with open(args.file, 'rb') as f:
+                try:
+                    data = CitizenFile.open(f)
+                    data.validate()
+                except ValueError as e:
+                    sys.exit(str(e))
+            with data:
+                print('citizens: {}\nrelations: {}\nstrings: {}\ntowns: {}'.format(
+                    data.count, data.relations, len(data.strings), len(numpy.unique(data.towns))))
+        else:
+            parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,14 @@
+import re
 from datetime import datetime
+from itertools import chain
 
+import numpy
 from marshmallow import Schema, fields, validates, ValidationError
 from marshmallow import validate
 
-from app import db
-from app.models import Citizen
+from app.models import Import
 from app.config import DATEFORMAT
+from app.serialize import FIELDS
 
 
 # schemes used only for validation
@@ -77,6 +80,148 @@ class InputDataSchema(Schema):
     citizens = fields.Nested(CitizenSchema, many=True, required=True, validate=unique_citizen_id)
 
 
+# fast path for POST /imports
+# applies the same rules as InputDataSchema in a single pass over plain python objects
+# it is stricter about types (no numeric strings instead of integers),
+# so None means "not sure" and the request has to go through InputDataSchema to get error messages
+
+CITIZEN_FIELDS = frozenset(CitizenSchema().fields)
+GENDERS = frozenset({"male", "female"})
+LETTER_OR_DIGIT = re.compile(r'[^\W_]')  # same as str.isalnum() for any character
+
+
+def parse_import(data) -> list:
+    # returns list of citizens with birth_date parsed to datetime or None
+    if type(data) is not dict or data.keys() != {'citizens'} or type(data['citizens']) is not list:
+        return None
+    now = datetime.utcnow()
+    dates = {}  # birth dates repeat a lot, strptime is called once per distinct value
+    ids = set()
+    citizens = []
+    for person in data['citizens']:
+        citizen = parse_citizen(person, now, dates)
+        if citizen is None or citizen['citizen_id'] in ids:
+            return None
+        ids.add(citizen['citizen_id'])
+        citizens.append(citizen)
+    return citizens
+
+
+def parse_citizen(person, now: datetime, dates: dict) -> dict:
+    # returns copy of citizen with birth_date parsed to datetime or None
+    # dates is a cache of already parsed birth dates shared between calls
+    if type(person) is not dict or person.keys() != CITIZEN_FIELDS:
+        return None
+    citizen_id = person['citizen_id']
+    if type(citizen_id) is not int or citizen_id < 0:
+        return None
+    for field in ('town', 'street', 'building'):
+        value = person[field]
+        if type(value) is not str or not 1 <= len(value) <= 1000 or not LETTER_OR_DIGIT.search(value):
+            return None
+    apartment = person['apartment']
+    if type(apartment) is not int or apartment < 0:
+        return None
+    name = person['name']
+    if type(name) is not str or not name:
+        return None
+    if type(person['gender']) is not str or person['gender'] not in GENDERS:
+        return None
+    relatives = person['relatives']
+    if type(relatives) is not list:
+        return None
+    for relative in relatives:
+        if type(relative) is not int or relative < 1:
+            return None
+    if len(relatives) != len(set(relatives)):
+        return None
+
+    value = person['birth_date']
+    if type(value) is not str:
+        return None
+    birth_date = dates.get(value)
+    if birth_date is None:
+        try:
+            birth_date = datetime.strptime(value, DATEFORMAT)
+        except ValueError:
+            return None
+        if birth_date > now:
+            return None
+        dates[value] = birth_date
+    return dict(person, birth_date=birth_date)
+
+
+def relations_symmetric(relations: dict) -> bool:
+    # relations are {citizen_id: [relative_id, ...]} with unique relatives
+    counts = numpy.fromiter(map(len, relations.values()), numpy.int64, len(relations))
+    relatives = numpy.fromiter(chain.from_iterable(relations.values()), numpy.int64, counts.sum())
+    citizens = numpy.repeat(numpy.fromiter(relations, numpy.int64, len(relations)), counts)
+    return edges_symmetric(citizens, relatives)
+
+
+def edges_symmetric(citizens: numpy.ndarray, relatives: numpy.ndarray) -> bool:
+    # relation i is citizens[i] -> relatives[i], relations are unique
+    # O(E log E) in numpy: each relation is packed into a single integer
+    # and valid graph equals to its reverse, self relations aside
+    if not len(citizens):
+        return True
+    size = max(citizens.max(), relatives.max()) + 1
+    if size > 2 ** 31:
+        # packed values would overflow int64
+        edges = set(zip(citizens.tolist(), relatives.tolist()))
+        return len(edges) == len(set(zip(relatives.tolist(), citizens.tolist())) & edges) \
+            and not (citizens == relatives).any()
+    return not (citizens == relatives).any() and \
+        numpy.array_equal(numpy.sort(citizens * size + relatives), numpy.sort(relatives * size + citizens))
+
+
+def relation_errors(relations: dict) -> list:
+    # returns messages about every self relation, unknown relative and one-sided relation
+    if relations_symmetric(relations):
+        return []
+
+    # something is wrong, collecting messages in order of appearance
+    errors = []
+    edges = []
+    for citizen, relatives in relations.items():
+        for relative in relatives:
+            if relative == citizen:
+                errors.append('Citizen {} is relatives with himself.'.format(relative))
+            elif relative not in relations:
+                errors.append('Citizen {} has unknown relative {}.'.format(citizen, relative))
+            else:
+                edges.append((citizen, relative))
+    edge_set = set(edges)
+    for citizen, relative in edges:
+        if (relative, citizen) not in edge_set:
+            errors.append('Relation between citizens {} and {} is one-sided.'.format(relative, citizen))
+    return errors
+
+
+def parse_citizens_query(args, max_limit: int) -> tuple:
+    # ?fields=name,town&after=10&limit=100 of GET /imports/$import_id/citizens
+    # returns (fields, after, limit), after and limit are None if not given
+    # raises ValueError with description of the first wrong parameter
+    fields = FIELDS
+    if 'fields' in args:
+        fields = tuple(field for field in args['fields'].split(',') if field)
+        unknown = set(fields) - set(FIELDS)
+        if unknown or not fields:
+            raise ValueError('Unknown fields: {}.'.format(', '.join(sorted(unknown))) if unknown else
+                             'At least one field is required.')
+    after = limit = None
+    try:
+        if 'after' in args:
+            after = int(args['after'])
+        if 'limit' in args:
+            limit = int(args['limit'])
+    except ValueError:
+        raise ValueError('Parameters after and limit have to be integers.')
+    if limit is not None and not 1 <= limit <= max_limit:
+        raise ValueError('Parameter limit has to be from 1 to {}.'.format(max_limit))
+    return fields, after, limit
+
+
 def import_present(import_id: int) -> bool:
     # checks if such import id presented in database
-    return db.session.query(Citizen.import_id).filter_by(import_id=import_id).first() is not None
+    return Import.query.get(import_id) is not None
@@ -0,0 +1,58 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from app import app, db, compress
+from benchmarks.datagen import generate_citizens
+
+# CPU cost of response compression against bytes saved
+# plain bodies of the three analytics routes are compressed with every available encoding and level
+#
+#   python3 -m benchmarks.bench_compress --citizens 10000
+
+ROUTES = ['citizens', 'citizens/birthdays', 'towns/stat/percentile/age']
+LEVELS = {'gzip': ('COMPRESSION_GZIP_LEVEL', [1, 6, 9]), 'zstd': ('COMPRESSION_ZSTD_LEVEL', [1, 3, 9])}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--citizens', type=int, default=10000)
+    parser.add_argument('--relations', type=int, default=1100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    db_fd, database_name = tempfile.mkstemp()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database_name
+    app.config['COMPRESSION'] = False
+    db.create_all()
+    client = app.test_client()
+    rv = client.post('/imports', data=json.dumps({'citizens': generate_citizens(args.citizens, args.relations)}),
+                     content_type='application/json')
+    import_id = json.loads(rv.data)['data']['import_id']
+    bodies = [(route, client.get('/imports/{}/{}'.format(import_id, route)).data) for route in ROUTES]
+
+    print('{:<28}{:>8}{:>12}{:>12}{:>10}{:>12}'.format('route', 'codec', 'plain, B', 'encoded, B', 'ratio',
+                                                       'time, ms'))
+    with app.app_context():
+        for route, body in bodies:
+            for encoding in compress.encodings():
+                setting, levels = LEVELS[encoding]
+                for level in levels:
+                    app.config[setting] = level
+                    start = time.perf_counter()
+                    for _ in range(args.repeat):
+                        encoded = compress.compress(body, encoding)
+                    elapsed = (time.perf_counter() - start) / args.repeat
+                    print('{:<28}{:>8}{:>12}{:>12}{:>10.2f}{:>12.2f}'.format(
+                        route, '{}-{}'.format(encoding, level), len(body), len(encoded),
+                        len(body) / len(encoded), elapsed * 1000))
+
+    db.session.remove()
+    os.close(db_fd)
+    os.unlink(database_name)
+
+
+if __name__ == '__main__':
+    main()
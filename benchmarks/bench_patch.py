@@ -0,0 +1,49 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from app import app, db
+from benchmarks.datagen import generate_citizens
+
+# PATCH latency when all relatives of a citizen are replaced
+# every request disconnects `fanout` relatives and connects `fanout` other ones
+#
+#   python3 -m benchmarks.bench_patch --fanout 10 50 100 500 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fanout', type=int, nargs='+', default=[10, 50, 100, 500, 1000])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    db_fd, database_name = tempfile.mkstemp()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database_name
+    db.create_all()
+    client = app.test_client()
+
+    size = 2 * max(args.fanout) + 1
+    rv = client.post('/imports', data=json.dumps({'citizens': generate_citizens(size)}),
+                     content_type='application/json')
+    import_id = json.loads(rv.data)['data']['import_id']
+    url = '/imports/{}/citizens/1'.format(import_id)
+
+    print('{:>8}{:>14}'.format('fanout', 'latency, ms'))
+    for fanout in args.fanout:
+        sets = [list(range(2, fanout + 2)), list(range(fanout + 2, 2 * fanout + 2))]
+        client.patch(url, data=json.dumps({'relatives': sets[1]}), content_type='application/json')
+        start = time.perf_counter()
+        for i in range(args.repeat):
+            rv = client.patch(url, data=json.dumps({'relatives': sets[i % 2]}), content_type='application/json')
+            assert rv.status_code == 200
+        print('{:>8}{:>14.2f}'.format(fanout, (time.perf_counter() - start) / args.repeat * 1000))
+
+    db.session.remove()
+    os.close(db_fd)
+    os.unlink(database_name)
+
+
+if __name__ == '__main__':
+    main()
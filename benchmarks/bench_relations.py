@@ -0,0 +1,39 @@
+import argparse
+import time
+
+from app.validate import relation_errors
+from benchmarks.datagen import generate_citizens
+
+# relation symmetry check of POST /imports on a dense family graph
+#
+#   python3 -m benchmarks.bench_relations --citizens 2000 --relations 50000
+
+
+def list_scan(relations: dict) -> bool:
+    # previous implementation: copies of relatives lists and linear `in` per relation
+    relations = {citizen: relatives.copy() for citizen, relatives in relations.items()}
+    for citizen, relatives in relations.items():
+        for relative in relatives:
+            if relative == citizen or citizen not in relations[relative]:
+                return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--citizens', type=int, default=2000)
+    parser.add_argument('--relations', type=int, default=50000)
+    args = parser.parse_args()
+
+    relations = {person['citizen_id']: person['relatives']
+                 for person in generate_citizens(args.citizens, args.relations)}
+    edges = sum(len(relatives) for relatives in relations.values())
+    print('{} citizens, {} directed relations'.format(args.citizens, edges))
+    for name, check in [('list scan', list_scan), ('packed sort', relation_errors)]:
+        start = time.perf_counter()
+        check(relations)
+        print('{:<12}{:>10.1f} ms'.format(name, (time.perf_counter() - start) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, text
+
+from app.models import Citizen
+from benchmarks.datagen import generate_citizens, DATEFORMAT
+
+# lookups used by the routes on citizens table
+# before: uuid primary key, no indexes
+# after:  (import_id, citizen_id) primary key, (import_id, town) and (import_id, birth month) indexes
+#
+#   python3 -m benchmarks.bench_schema --rows 1000000
+
+OLD_SCHEMA = ('CREATE TABLE citizens ('
+              'uuid VARCHAR(32) NOT NULL, citizen_id INTEGER, import_id INTEGER, '
+              'town VARCHAR, street VARCHAR, building VARCHAR, apartment INTEGER, '
+              'name VARCHAR, birth_date DATETIME, gender VARCHAR, '
+              'PRIMARY KEY (uuid))')
+
+QUERIES = {
+    'import_present': 'SELECT import_id FROM citizens WHERE import_id = :import_id LIMIT 1',
+    'max_import_id': 'SELECT max(import_id) FROM citizens',
+    'citizen_by_id': 'SELECT * FROM citizens WHERE import_id = :import_id AND citizen_id = :citizen_id',
+    'town_citizens': 'SELECT birth_date FROM citizens WHERE import_id = :import_id AND town = :town',
+    'month_citizens': "SELECT citizen_id FROM citizens WHERE import_id = :import_id "
+                      "AND CAST(STRFTIME('%m', birth_date) AS INTEGER) = :month",
+}
+
+
+def fill(engine, rows: int, import_size: int, with_uuid: bool):
+    template = generate_citizens(import_size)
+    for person in template:
+        person['birth_date'] = datetime.strptime(person['birth_date'], DATEFORMAT)
+        del person['relatives']
+    columns = list(template[0]) + ['import_id'] + (['uuid'] if with_uuid else [])
+    insert = text('INSERT INTO citizens ({}) VALUES ({})'.format(
+        ', '.join(columns), ', '.join(':' + column for column in columns)))
+    with engine.begin() as connection:
+        for import_id in range(1, rows // import_size + 1):
+            batch = []
+            for person in template:
+                row = dict(person, import_id=import_id)
+                if with_uuid:
+                    row['uuid'] = '{}-{}'.format(import_id, person['citizen_id'])
+                batch.append(row)
+            connection.execute(insert, batch)
+
+
+def measure(engine, import_id: int, repeat: int) -> dict:
+    params = dict(import_id=import_id, citizen_id=import_id % 1000 + 1, town='Москва', month=4)
+    results = {}
+    with engine.connect() as connection:
+        for name, query in QUERIES.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                connection.execute(text(query), params).fetchall()
+            results[name] = (time.perf_counter() - start) / repeat
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--import-size', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    before = create_engine('sqlite:///' + os.path.join(directory, 'before.db'))
+    before.execute(OLD_SCHEMA)
+    fill(before, args.rows, args.import_size, with_uuid=True)
+
+    after = create_engine('sqlite:///' + os.path.join(directory, 'after.db'))
+    Citizen.__table__.create(after)
+    fill(after, args.rows, args.import_size, with_uuid=False)
+
+    import_id = args.rows // args.import_size // 2 + 1
+    before_results = measure(before, import_id, args.repeat)
+    after_results = measure(after, import_id, args.repeat)
+    print('{:<16}{:>14}{:>14}{:>10}'.format('query', 'before, ms', 'after, ms', 'speedup'))
+    for name in QUERIES:
+        print('{:<16}{:>14.3f}{:>14.3f}{:>9.0f}x'.format(
+            name, before_results[name] * 1000, after_results[name] * 1000,
+            before_results[name] / after_results[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from flask.json import dumps as flask_dumps
+
+from app import app, db, serialize
+from app.config import DATEFORMAT
+from app.models import Citizen, load_relatives
+from benchmarks.datagen import generate_citizens
+
+# serialization of GET /imports/$import_id/citizens body without HTTP
+# ORM instances with per-row strftime and Flask encoder against column rows with cached dates
+# encoded by stdlib json and by orjson
+#
+#   python3 -m benchmarks.bench_serialize --citizens 10000
+
+
+def orm_path(import_id):
+    relatives = load_relatives(import_id)
+    citizens = Citizen.query.filter_by(import_id=import_id).order_by(Citizen.citizen_id)
+    return flask_dumps({'data': [dict(person.to_dict(relatives.get(person.citizen_id, [])),
+                                      birth_date=person.birth_date.strftime(DATEFORMAT))
+                                 for person in citizens]}, separators=(',', ':'))
+
+
+def columns_path(fast_json):
+    def path(import_id):
+        app.config['FAST_JSON'] = fast_json
+        return b''.join(serialize.citizens_json(import_id))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--citizens', type=int, default=10000)
+    parser.add_argument('--relations', type=int, default=1100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    db_fd, database_name = tempfile.mkstemp()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database_name
+    db.create_all()
+    client = app.test_client()
+    rv = client.post('/imports', data=json.dumps({'citizens': generate_citizens(args.citizens, args.relations)}),
+                     content_type='application/json')
+    import_id = json.loads(rv.data)['data']['import_id']
+
+    paths = [('orm', orm_path), ('columns', columns_path(False))]
+    if serialize.orjson is not None:
+        paths.append(('orjson', columns_path(True)))
+    print('{:<12}{:>12}{:>16}'.format('path', 'time, ms', 'citizens/s'))
+    with app.app_context():
+        expected = json.loads(orm_path(import_id))
+        for name, path in paths:
+            assert json.loads(path(import_id)) == expected
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                path(import_id)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            print('{:<12}{:>12.1f}{:>16.0f}'.format(name, elapsed * 1000, args.citizens / elapsed))
+
+    db.session.remove()
+    os.close(db_fd)
+    os.unlink(database_name)
+
+
+if __name__ == '__main__':
+    main()
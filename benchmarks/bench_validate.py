@@ -0,0 +1,45 @@
+import argparse
+import time
+from datetime import datetime
+
+from app.config import DATEFORMAT
+from app.validate import InputDataSchema, parse_import
+from benchmarks.datagen import generate_citizens
+
+# validation of POST /imports payload
+# marshmallow schema followed by strptime of every birth date against single pass fast path
+#
+#   python3 -m benchmarks.bench_validate --citizens 10000
+
+
+def marshmallow_path(data):
+    assert not InputDataSchema().validate(data)
+    return [dict(person, birth_date=datetime.strptime(person['birth_date'], DATEFORMAT))
+            for person in data['citizens']]
+
+
+def fast_path(data):
+    citizens = parse_import(data)
+    assert citizens is not None
+    return citizens
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--citizens', type=int, default=10000)
+    parser.add_argument('--relations', type=int, default=1100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    data = {'citizens': generate_citizens(args.citizens, args.relations)}
+    print('{:<12}{:>12}{:>16}'.format('path', 'time, ms', 'citizens/s'))
+    for name, path in [('marshmallow', marshmallow_path), ('fast', fast_path)]:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            path(data)
+        elapsed = (time.perf_counter() - start) / args.repeat
+        print('{:<12}{:>12.1f}{:>16.0f}'.format(name, elapsed * 1000, args.citizens / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+
+from benchmarks.datagen import generate_citizens
+
+# throughput of gunicorn with different number of workers
+# response cache is disabled, so every request reaches the database
+#
+#   python3 -m benchmarks.bench_workers --workers 1 2 4 --route birthdays
+
+ROUTES = {
+    'citizens': '/imports/{}/citizens',
+    'birthdays': '/imports/{}/citizens/birthdays',
+    'percentile': '/imports/{}/towns/stat/percentile/age',
+}
+
+
+def wait_until_up(url: str, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urlopen(url, timeout=1)
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server is not responding')
+
+
+def run(workers: int, args, database_url: str) -> float:
+    port = 18000 + workers
+    env = dict(os.environ, DATABASE_URL=database_url, WEB_CONCURRENCY=str(workers),
+               BIND='127.0.0.1:{}'.format(port), RESPONSE_CACHE='0', ACCESS_LOG='')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'server_rest_api:app'],
+                              env=env, stderr=subprocess.DEVNULL)
+    base = 'http://127.0.0.1:{}'.format(port)
+    try:
+        wait_until_up(base + '/cache/stats')
+        url = base + ROUTES[args.route].format(1)
+
+        def fetch(_):
+            with urlopen(url, timeout=60) as response:
+                response.read()
+
+        with ThreadPoolExecutor(args.clients) as executor:
+            list(executor.map(fetch, range(args.clients)))  # warm up
+            start = time.perf_counter()
+            list(executor.map(fetch, range(args.requests)))
+            return args.requests / (time.perf_counter() - start)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--route', choices=ROUTES, default='birthdays')
+    parser.add_argument('--citizens', type=int, default=10000)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    database_url = args.database_url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    from app import app, db
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    db.create_all()
+    rv = app.test_client().post('/imports', data=json.dumps({'citizens': generate_citizens(args.citizens, 1100)}),
+                                content_type='application/json')
+    assert rv.status_code == 201
+    db.session.remove()
+    db.engine.dispose()
+
+    print('{:>8}{:>10}'.format('workers', 'req/s'))
+    for workers in args.workers:
+        print('{:>8}{:>10.1f}'.format(workers, run(workers, args, database_url)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+from itertools import accumulate
+from random import Random
+from string import ascii_lowercase
+
+# seeded generator of /imports payloads
+# same shape as tests/generate_citizens.py, but parametrised and reproducible
+
+TOWNS = ["Москва", "С.Петербург", "Свинбург",
+         "Алексеево", "Олександрово", "Берлин",
+         "Владивосток", "Архангельск"]
+
+ALPHABET = ".!,#" + ascii_lowercase + "".join(str(i) for i in range(10))
+DATEFORMAT = "%d.%m.%Y"
+
+FIRST_DATE = datetime(1901, 1, 1)
+LAST_DATE = datetime(2019, 8, 20)
+
+
+def town_names(count: int) -> list:
+    return TOWNS[:count] + ['Город {}'.format(i) for i in range(len(TOWNS), count)]
+
+
+def generate_citizens(n: int, relations: int = 0, seed: int = 0, towns: int = len(TOWNS),
+                      town_skew: float = 0.0) -> list:
+    # n citizens with ~relations symmetric relations between them
+    # town of a citizen follows Zipf law with town_skew exponent (0 is uniform)
+    rnd = Random(seed)
+
+    def random_string(size):
+        return "".join(rnd.choice(ALPHABET) for _ in range(size))
+
+    names = town_names(towns)
+    weights = list(accumulate(1 / (rank ** town_skew) for rank in range(1, towns + 1)))
+    days = (LAST_DATE - FIRST_DATE).days
+    citizens = []
+    for citizen_id in range(1, n + 1):
+        citizens.append(dict(citizen_id=citizen_id,
+                             town=rnd.choices(names, cum_weights=weights)[0] if town_skew else rnd.choice(names),
+                             street=random_string(30),
+                             building=random_string(10),
+                             apartment=rnd.randint(1, 10 ** 4),
+                             name='{0} {1}'.format(random_string(10).capitalize(), random_string(10).capitalize()),
+                             birth_date=(FIRST_DATE + timedelta(days=rnd.randrange(days))).strftime(DATEFORMAT),
+                             gender=rnd.choice(['female', 'male']),
+                             relatives=[]))
+
+    # relatives lists are small, sets are used only to skip duplicates
+    connected = set()
+    for _ in range(relations):
+        emitter, receiver = rnd.randint(1, n), rnd.randint(1, n)
+        if emitter != receiver and (emitter, receiver) not in connected:
+            connected.add((emitter, receiver))
+            connected.add((receiver, emitter))
+            citizens[receiver - 1]['relatives'].append(emitter)
+            citizens[emitter - 1]['relatives'].append(receiver)
+    return citizens
@@ -0,0 +1,187 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from random import Random
+from threading import Thread
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import numpy
+
+from benchmarks.datagen import generate_citizens, town_names
+
+# load test of all five routes
+# drives the app either through flask test client or over HTTP (werkzeug server in this process)
+# and writes latency percentiles, throughput and peak RSS of every route to JSON
+# with --baseline results are compared and exit code is 1 on regression above --threshold
+#
+#   python3 -m benchmarks.suite --citizens 10000 --output results.json
+#   python3 -m benchmarks.suite --citizens 10000 --baseline results.json
+#   python3 -m benchmarks.suite --transport http --database-url postgresql://localhost/bench
+
+
+class TestClientTransport(object):
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method: str, url: str, body: bytes = None) -> tuple:
+        rv = self.client.open(url, method=method, data=body, content_type='application/json')
+        return rv.status_code, rv.data
+
+    def close(self):
+        pass
+
+
+class HTTPTransport(object):
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def request(self, method: str, url: str, body: bytes = None) -> tuple:
+        request = Request(self.base + url, data=body, method=method,
+                          headers={'Content-Type': 'application/json'})
+        try:
+            with urlopen(request, timeout=300) as response:
+                return response.status, response.read()
+        except HTTPError as e:
+            return e.code, e.read()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def measure(transport, requests: list, concurrency: int) -> dict:
+    # requests are (method, url, body, expected status)
+    def send(request):
+        method, url, body, expected = request
+        start = time.perf_counter()
+        status, _ = transport.request(method, url, body)
+        elapsed = time.perf_counter() - start
+        if status != expected:
+            raise RuntimeError('{} {} responded with {}'.format(method, url, status))
+        return elapsed
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as executor:
+            latencies = list(executor.map(send, requests))
+    else:
+        latencies = [send(request) for request in requests]
+    total = time.perf_counter() - start
+    p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99]) * 1000
+    return dict(requests=len(requests), p50_ms=round(p50, 3), p95_ms=round(p95, 3), p99_ms=round(p99, 3),
+                throughput_rps=round(len(requests) / total, 2),
+                peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1))
+
+
+def run(args) -> dict:
+    database_url = args.database_url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    from app import app, db
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    app.config['RESPONSE_CACHE'] = args.cache
+    db.create_all()
+    db.session.remove()
+
+    transport = (HTTPTransport if args.transport == 'http' else TestClientTransport)(app)
+    rnd = Random(args.seed)
+    citizens = generate_citizens(args.citizens, int(args.citizens * args.density / 2), args.seed,
+                                 args.towns, args.town_skew)
+    payload = json.dumps({'citizens': citizens}).encode()
+    results = {}
+    try:
+        results['post_imports'] = measure(transport, [('POST', '/imports', payload, 201)] * args.imports, 1)
+        import_id = json.loads(transport.request('POST', '/imports', payload)[1])['data']['import_id']
+
+        for route, url in [('get_citizens', '/imports/{}/citizens'),
+                           ('get_birthdays', '/imports/{}/citizens/birthdays'),
+                           ('get_percentile', '/imports/{}/towns/stat/percentile/age')]:
+            requests = [('GET', url.format(import_id), None, 200)] * args.repeat
+            results[route] = measure(transport, requests, args.concurrency)
+
+        towns = town_names(args.towns)
+        patches = []
+        for _ in range(args.repeat):
+            citizen_id = rnd.randint(1, args.citizens)
+            relatives = rnd.sample(range(1, args.citizens + 1), min(args.citizens, max(1, round(args.density))))
+            changes = {'town': rnd.choice(towns), 'relatives': [r for r in relatives if r != citizen_id]}
+            patches.append(('PATCH', '/imports/{}/citizens/{}'.format(import_id, citizen_id),
+                            json.dumps(changes).encode(), 200))
+        # concurrent PATCHes of one import would only measure lock waiting in SQLite
+        results['patch_citizen'] = measure(transport, patches, 1)
+    finally:
+        transport.close()
+
+    return dict(
+        parameters=dict(citizens=args.citizens, density=args.density, towns=args.towns, town_skew=args.town_skew,
+                        seed=args.seed, transport=args.transport, concurrency=args.concurrency, cache=args.cache,
+                        database=database_url.split(':')[0]),
+        routes=results,
+    )
+
+
+def regressions(results: dict, baseline: dict, threshold: float) -> list:
+    # returns descriptions of metrics worse than baseline by more than threshold (relative)
+    found = []
+    for route, metrics in results['routes'].items():
+        base = baseline['routes'].get(route)
+        if base is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_mb'):
+            if metrics[metric] > base[metric] * (1 + threshold):
+                found.append('{} {}: {} > {}'.format(route, metric, metrics[metric], base[metric]))
+        if metrics['throughput_rps'] < base['throughput_rps'] * (1 - threshold):
+            found.append('{} throughput_rps: {} < {}'.format(
+                route, metrics['throughput_rps'], base['throughput_rps']))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--citizens', type=int, default=10000)
+    parser.add_argument('--density', type=float, default=0.2, help='average number of relatives of a citizen')
+    parser.add_argument('--towns', type=int, default=8)
+    parser.add_argument('--town-skew', type=float, default=0.0, help='Zipf exponent of town sizes, 0 is uniform')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--imports', type=int, default=3, help='number of measured POST /imports')
+    parser.add_argument('--repeat', type=int, default=20, help='number of measured requests of other routes')
+    parser.add_argument('--concurrency', type=int, default=1, help='parallel clients of GET routes')
+    parser.add_argument('--transport', choices=['client', 'http'], default='client')
+    parser.add_argument('--cache', action='store_true', help='keep response cache enabled')
+    parser.add_argument('--database-url', help='SQLite file in a temporary directory by default')
+    parser.add_argument('--output', help='JSON file for results')
+    parser.add_argument('--baseline', help='JSON file with results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run(args)
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['parameters'] != results['parameters']:
+            print('warning: baseline was recorded with different parameters', file=sys.stderr)
+        found = regressions(results, baseline, args.threshold)
+        for regression in found:
+            print('regression: ' + regression, file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
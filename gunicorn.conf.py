@@ -0,0 +1,21 @@
+import multiprocessing
+import os
+
+# production serving of the service
+#
+#   gunicorn -c gunicorn.conf.py server_rest_api:app
+#
+# app is imported once in the master process (preload) and forked into workers
+
+bind = os.environ.get('BIND', '0.0.0.0:8080')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('WEB_THREADS', 1))
+preload_app = True
+timeout = 120
+accesslog = os.environ.get('ACCESS_LOG', '-') or None
+
+
+def post_fork(server, worker):
+    # connections opened by master (db.create_all at import) must not be shared between processes
+    from app import db
+    db.engine.dispose()
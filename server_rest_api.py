@@ -1,4 +1,5 @@
 from app import app
 
+# development server, see gunicorn.conf.py for production serving
 if __name__ == '__main__':
     app.run(debug=False, host='0.0.0.0', port=8080)
@@ -1,6 +1,11 @@
 import json
+import random
+import time
+from datetime import date, datetime, timedelta
 
-from app import app, db
+import numpy
+
+from app import app, db, metrics
 import os
 import tempfile
 
@@ -398,3 +403,936 @@ def test_patch(client):
     rv = client.patch('/imports/{}/citizens/1'.format(import_id), data=json.dumps(data),
                       content_type='application/json')
     assert rv.status_code == 400
+
+
+def test_birthdays_presents_count(client):
+    # every relative buys a present, presents are summed per month
+    with open('tests/citizens2.json') as f:
+        original_data = json.load(f)
+    rv = client.post('/imports', data=json.dumps(original_data), content_type='application/json')
+    assert rv.status_code == 201
+    import_id = json.loads(rv.data)['data']['import_id']
+
+    citizens = {c['citizen_id']: c for c in original_data['citizens']}
+    expected = {str(month): {} for month in range(1, 12 + 1)}
+    for citizen in citizens.values():
+        month = str(int(citizen['birth_date'].split('.')[1]))
+        for relative in citizen['relatives']:
+            expected[month][relative] = expected[month].get(relative, 0) + 1
+
+    rv = client.get('/imports/{}/citizens/birthdays'.format(import_id))
+    assert rv.status_code == 200
+    response_data = json.loads(rv.data)['data']
+    assert {month: {p['citizen_id']: p['presents'] for p in presents}
+            for month, presents in response_data.items()} == expected
+
+
+def expected_percentiles(citizens):
+    # age percentiles computed from scratch over citizens list
+    today = datetime.utcnow()
+    ages = {}
+    for citizen in citizens:
+        born = datetime.strptime(citizen['birth_date'], '%d.%m.%Y')
+        age = today.year - born.year - ((today.month, today.day) < (born.month, born.day))
+        ages.setdefault(citizen['town'], []).append(age)
+    return {town: {'town': town,
+                   'p50': round(numpy.percentile(town_ages, 50), 2),
+                   'p75': round(numpy.percentile(town_ages, 75), 2),
+                   'p99': round(numpy.percentile(town_ages, 99), 2)}
+            for town, town_ages in ages.items()}
+
+
+def test_percentile_after_patch(client):
+    # town birth dates are updated by PATCH
+    with open('tests/citizens1.json') as f:
+        original_data = json.load(f)
+    rv = client.post('/imports', data=json.dumps(original_data), content_type='application/json')
+    assert rv.status_code == 201
+    import_id = json.loads(rv.data)['data']['import_id']
+
+    for citizen_id, data in [(1, {'town': 'Керчь'}),
+                             (3, {'birth_date': '01.01.1950'}),
+                             (2, {'town': 'Тверь', 'birth_date': '12.12.2012'}),
+                             (1, {'town': 'Москва', 'birth_date': '26.12.1900'})]:
+        rv = client.patch('/imports/{}/citizens/{}'.format(import_id, citizen_id), data=json.dumps(data),
+                          content_type='application/json')
+        assert rv.status_code == 200
+
+        rv = client.get('/imports/{}/citizens'.format(import_id))
+        expected = expected_percentiles(json.loads(rv.data)['data'])
+        rv = client.get('/imports/{}/towns/stat/percentile/age'.format(import_id))
+        assert rv.status_code == 200
+        assert {elem['town']: elem for elem in json.loads(rv.data)['data']} == expected
+
+
+def test_vectorized_percentiles():
+    # vectorized ages and percentiles are identical to per citizen computation
+    from app.stats import age_percentiles
+
+    rnd = random.Random(1)
+    towns = ['Москва', 'Керчь', 'Тверь', 'Омск']
+    citizens = [(rnd.choice(towns), date(1900, 1, 1) + timedelta(days=rnd.randrange(43000)))
+                for _ in range(5000)]
+    citizens += [('Керчь', date(2000, 2, 29)), ('Омск', date(2004, 2, 29)), ('Тверь', date(2019, 3, 1))]
+
+    for today in [date(2019, 2, 28), date(2020, 2, 29), date(2020, 3, 1), date(2021, 12, 31), date.today()]:
+        expected = {}
+        for town in towns:
+            ages = [today.year - born.year - ((today.month, today.day) < (born.month, born.day))
+                    for t, born in citizens if t == town]
+            expected[town] = {
+                'town': town,
+                'p50': round(numpy.percentile(ages, 50), 2),
+                'p75': round(numpy.percentile(ages, 75), 2),
+                'p99': round(numpy.percentile(ages, 99), 2),
+            }
+        towns_column, dates_column = zip(*citizens)
+        result = age_percentiles(towns_column, dates_column, [1] * len(citizens), today)
+        assert {elem['town']: elem for elem in result} == expected
+
+
+def test_streaming_citizens(client):
+    # streamed response is the same document as buffered one, whatever the batch size
+    with open('tests/citizens2.json') as f:
+        original_data = json.load(f)
+    rv = client.post('/imports', data=json.dumps(original_data), content_type='application/json')
+    assert rv.status_code == 201
+    import_id = json.loads(rv.data)['data']['import_id']
+
+    responses = []
+    for streaming, batch_size in [(False, 1000), (True, 1000), (True, 7), (True, 1)]:
+        app.config['STREAM_CITIZENS'] = streaming
+        app.config['STREAM_BATCH_SIZE'] = batch_size
+        app.config['RESPONSE_CACHE'] = False
+        try:
+            rv = client.get('/imports/{}/citizens'.format(import_id))
+        finally:
+            app.config['STREAM_CITIZENS'] = True
+            app.config['STREAM_BATCH_SIZE'] = 1000
+            app.config['RESPONSE_CACHE'] = True
+        assert rv.status_code == 200
+        responses.append(rv.data)
+    assert all(data == responses[0] for data in responses)
+    assert len(json.loads(responses[0])['data']) == len(original_data['citizens'])
+
+
+def test_fast_validation():
+    # fast path never accepts data rejected by InputDataSchema
+    from app.validate import parse_import, InputDataSchema
+
+    with open('tests/citizens1.json') as f:
+        data = json.load(f)
+    assert parse_import(data) is not None
+    assert parse_import(data)[1]['birth_date'] == datetime(2000, 4, 1)
+
+    values = [None, -1, 0, 1, 1.0, True, '1', '-1', '', ' ', '_', 'a', 'a' * 1001, '32.01.2019',
+              '29.02.2019', '29.02.2016', '01.01.2030', '2000-01-01', 'male', 'NULL', [], [1], [1, 1], [0],
+              [2, 3], ['1'], [True], {}, {1: 2}]
+    for field in list(data['citizens'][0]) + ['unknown']:
+        for value in values:
+            citizens = json.loads(json.dumps(data))
+            citizens['citizens'][0][field] = value
+            if parse_import(citizens) is not None:
+                assert not InputDataSchema().validate(citizens), (field, value)
+
+    for citizens in [None, [], {}, {'citizens': None}, {'citizens': {}}, {'citizens': [None]}, {'citizens': [1]},
+                     {'citizens': data['citizens'], 'import_id': 1},
+                     {'citizens': [data['citizens'][0], data['citizens'][0]]}]:
+        assert parse_import(citizens) is None
+
+
+def test_relation_errors():
+    # every violation is reported
+    from app.validate import relation_errors
+
+    assert relation_errors({1: [2], 2: [1, 3], 3: [2]}) == []
+    assert relation_errors({}) == []
+    assert relation_errors({1: [1, 2, 5], 2: [3], 3: [2], 4: [2]}) == [
+        'Citizen 1 is relatives with himself.',
+        'Citizen 1 has unknown relative 5.',
+        'Relation between citizens 2 and 1 is one-sided.',
+        'Relation between citizens 2 and 4 is one-sided.',
+    ]
+    # packed keys do not collide for large ids
+    assert relation_errors({0: [2 ** 40], 2 ** 40: [0], 1: [], 2 ** 40 + 1: []}) == []
+    assert relation_errors({2: [1], 1: [], 1 << 2 | 1: []}) == ['Relation between citizens 1 and 2 is one-sided.']
+
+
+@pytest.mark.timeout(60)
+def test_concurrent_imports(client):
+    # parallel imports under a multi-process server get distinct ids
+    from concurrent.futures import ThreadPoolExecutor
+    from threading import Thread
+    from urllib.request import Request, urlopen
+    from werkzeug.serving import make_server
+
+    with open('tests/citizens1.json') as f:
+        payload = f.read().encode()
+
+    server = make_server('127.0.0.1', 0, app, processes=4)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:{}/imports'.format(server.server_port)
+
+    def post_import(_):
+        request = Request(url, data=payload, headers={'Content-Type': 'application/json'})
+        with urlopen(request, timeout=30) as response:
+            assert response.status == 201
+            return json.loads(response.read())['data']['import_id']
+
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            import_ids = list(executor.map(post_import, range(32)))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert sorted(import_ids) == list(range(1, 32 + 1))
+
+    for import_id in import_ids:
+        rv = client.get('/imports/{}/citizens'.format(import_id))
+        assert rv.status_code == 200
+        assert len(json.loads(rv.data)['data']) == 3
+
+
+def test_response_cache(client):
+    # repeated GETs are served from cache, PATCH changes ETag
+    with open('tests/citizens1.json') as f:
+        original_data = json.load(f)
+    rv = client.post('/imports', data=json.dumps(original_data), content_type='application/json')
+    assert rv.status_code == 201
+    import_id = json.loads(rv.data)['data']['import_id']
+
+    for route in ['citizens', 'citizens/birthdays', 'towns/stat/percentile/age']:
+        url = '/imports/{}/{}'.format(import_id, route)
+        first = client.get(url)
+        assert first.status_code == 200
+        first_data = first.data  # streamed body is stored once it has been read
+        assert first.headers['X-Cache'] == 'MISS'
+        second = client.get(url)
+        assert second.headers['X-Cache'] == 'HIT'
+        assert second.data == first_data
+        assert second.headers['ETag'] == first.headers['ETag']
+
+        rv = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+        assert rv.status_code == 304
+        assert rv.data == b''
+
+    rv = client.get('/imports/{}/citizens'.format(import_id))
+    etag = rv.headers['ETag']
+    rv = client.patch('/imports/{}/citizens/3'.format(import_id), data=json.dumps({'name': 'Мария'}),
+                      content_type='application/json')
+    assert rv.status_code == 200
+
+    rv = client.get('/imports/{}/citizens'.format(import_id), headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers['X-Cache'] == 'MISS'
+    assert rv.headers['ETag'] != etag
+    assert json.loads(rv.data)['data'][2]['name'] == 'Мария'
+
+    rv = client.get('/cache/stats')
+    assert rv.status_code == 200
+    assert set(json.loads(rv.data)['data']) == {'hits', 'misses', 'not_modified'}
+
+
+def wait_for_job(client, job_id):
+    for _ in range(200):
+        rv = client.get('/imports/jobs/{}'.format(job_id))
+        assert rv.status_code == 200
+        job = json.loads(rv.data)['data']
+        if job['status'] in ('done', 'failed'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError('job {} is not finished'.format(job_id))
+
+
+@pytest.mark.timeout(30)
+def test_async_imports(client):
+    # import in background with status polling
+    with open('tests/citizens1.json') as f:
+        original_data = json.load(f)
+    async_headers = {'Prefer': 'respond-async'}
+
+    rv = client.post('/imports', data=json.dumps(original_data), content_type='application/json',
+                     headers=async_headers)
+    assert rv.status_code == 202
+    job_id = json.loads(rv.data)['data']['job_id']
+    assert rv.headers['Location'].endswith('/imports/jobs/{}'.format(job_id))
+    job = wait_for_job(client, job_id)
+    assert job['status'] == 'done'
+    rv = client.get('/imports/{}/citizens'.format(job['import_id']))
+    assert json.loads(rv.data)['data'] == original_data['citizens']
+
+    original_data['citizens'][0]['relatives'] = [3]
+    for data in [json.dumps(original_data), '{"citizens": [', '{}']:
+        rv = client.post('/imports', data=data, content_type='application/json', headers=async_headers)
+        assert rv.status_code == 202
+        job = wait_for_job(client, json.loads(rv.data)['data']['job_id'])
+        assert job['status'] == 'failed'
+        assert job['import_id'] is None
+        assert job['error']
+
+    rv = client.get('/imports/jobs/999')
+    assert rv.status_code == 400
+
+    # backpressure
+    from app import jobs
+    executor, slots = jobs._pool()
+    acquired = 0
+    while slots.acquire(blocking=False):
+        acquired += 1
+    try:
+        rv = client.post('/imports', data=json.dumps(original_data), content_type='application/json',
+                         headers=async_headers)
+        assert rv.status_code == 503
+    finally:
+        for _ in range(acquired):
+            slots.release()
+
+
+def test_json_stream_reader():
+    # items are the same as parsed by json module whatever the chunk size
+    import io
+    from app.jsonstream import ArrayReader, UnknownKey
+
+    with open('tests/citizens1.json', 'rb') as f:
+        document = f.read()
+    expected = json.loads(document)['citizens']
+    for chunk_size in [1, 2, 3, 7, 64, 1 << 20]:
+        reader = ArrayReader(io.BytesIO(document), 'citizens', chunk_size)
+        assert list(reader) == expected
+        assert reader.found
+
+    for document, items in [(b'{}', []), (b' {"citizens" : [ ] } ', []), (b'{"citizens":[1,22,333]}', [1, 22, 333]),
+                            (b'{"citizens":[{"a":"\\u0416]"}, "\xd0\x96"]}', [{'a': 'Ж]'}, 'Ж'])]:
+        for chunk_size in [1, 2, 5]:
+            assert list(ArrayReader(io.BytesIO(document), 'citizens', chunk_size)) == items
+
+    for document in [b'', b'[]', b'{"citizens": [1, 2}', b'{"citizens": [1 2]}', b'{"citizens": []} 1',
+                     b'{"citizens": [1], "citizens": [2]}', b'{"citizens": [{"a": 1]}', b'{"citizens": [1,]}']:
+        with pytest.raises(ValueError):
+            list(ArrayReader(io.BytesIO(document), 'citizens', 2))
+    with pytest.raises(UnknownKey):
+        list(ArrayReader(io.BytesIO(b'{"citizens": [], "import_id": 1}'), 'citizens'))
+
+
+def test_streaming_import(client):
+    # incremental import gives the same results and rolls back on errors
+    app.config['IMPORT_STREAM_MIN_BYTES'] = 0
+    app.config['IMPORT_STREAM_BATCH_SIZE'] = 300
+    try:
+        with open('tests/citizens2.json') as f:
+            original_data = json.load(f)
+        rv = client.post('/imports', data=json.dumps(original_data), content_type='application/json')
+        assert rv.status_code == 201
+        import_id = json.loads(rv.data)['data']['import_id']
+        rv = client.get('/imports/{}/citizens'.format(import_id))
+        response_data = json.loads(rv.data)['data']
+        assert len(response_data) == len(original_data['citizens'])
+        for c1, c2 in zip(response_data, original_data['citizens']):
+            c1['relatives'].sort()
+            c2['relatives'].sort()
+            assert c1 == c2
+
+        with open('tests/citizens1.json') as f:
+            data = json.load(f)
+        invalid = []
+        for citizen_id, field, value in [(1, 'relatives', [3]), (1, 'relatives', [1]), (1, 'relatives', [2, 5]),
+                                         (3, 'birth_date', '01.01.2030'), (3, 'citizen_id', 1), (2, 'town', '')]:
+            changed = json.loads(json.dumps(data))
+            changed['citizens'][citizen_id - 1][field] = value
+            invalid.append(json.dumps(changed))
+        invalid += ['{"citizens": [', '{"data": []}', '{}', '[]', '{"citizens": [null]}']
+        for body in invalid:
+            rv = client.post('/imports', data=body, content_type='application/json')
+            assert rv.status_code == 400, body
+            # nothing is left of the failed import
+            rv = client.get('/imports/{}/citizens'.format(import_id + 1))
+            assert rv.status_code == 400
+
+        rv = client.post('/imports', data=json.dumps(data), content_type='application/json')
+        assert rv.status_code == 201
+        rv = client.get('/imports/{}/towns/stat/percentile/age'.format(json.loads(rv.data)['data']['import_id']))
+        assert rv.status_code == 200
+        assert {elem['town']: elem for elem in json.loads(rv.data)['data']} == expected_percentiles(data['citizens'])
+
+        # database is not locked while the body is being read
+        import io
+        import sqlite3
+        from app import ingest
+
+        class SlowUpload(io.BytesIO):
+            reads = 0
+
+            def read(self, size=-1):
+                other = sqlite3.connect(app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):], timeout=0)
+                try:
+                    other.execute('BEGIN IMMEDIATE')
+                    other.rollback()
+                finally:
+                    other.close()
+                self.reads += 1
+                return super().read(size)
+
+        upload = SlowUpload(json.dumps(original_data).encode())
+        with app.test_request_context():
+            import_id = ingest.import_stream(upload)
+        assert upload.reads > 2
+        rv = client.get('/imports/{}/citizens'.format(import_id))
+        assert len(json.loads(rv.data)['data']) == len(original_data['citizens'])
+    finally:
+        app.config['IMPORT_STREAM_MIN_BYTES'] = 4 * 1024 * 1024
+        app.config['IMPORT_STREAM_BATCH_SIZE'] = 1000
+
+
+def test_instrumentation(client):
+    # request breakdown in Server-Timing header, totals per route on /metrics, profiles of slowest requests
+    app.config['INSTRUMENTATION'] = True
+    app.config['PROFILE_SLOWEST'] = 2
+    app.config['RESPONSE_CACHE'] = False
+    metrics.reset()
+    try:
+        with open('tests/citizens1.json') as f:
+            original_data = json.load(f)
+        rv = client.post('/imports', data=json.dumps(original_data), content_type='application/json')
+        assert rv.status_code == 201
+        import_id = json.loads(rv.data)['data']['import_id']
+
+        rv = client.get('/imports/{}/citizens/birthdays'.format(import_id))
+        assert rv.status_code == 200
+        timing = rv.headers['Server-Timing']
+        assert 'db;dur=' in timing and 'serialize;dur=' in timing and 'total;dur=' in timing
+        assert int(timing.split('desc="')[1].split()[0]) > 0
+        for _ in range(3):
+            rv = client.get('/imports/{}/citizens'.format(import_id))
+            assert len(json.loads(rv.data)['data']) == len(original_data['citizens'])
+
+        rv = client.get('/metrics')
+        assert rv.status_code == 200
+        text = rv.data.decode()
+        assert 'app_requests_total{route="get_import",method="GET",status="200"} 3' in text
+        assert 'app_request_duration_seconds_count{route="get_birthdays",method="GET"} 1' in text
+        assert 'app_response_cache_hits_total' in text
+        rows = [line for line in text.splitlines() if line.startswith('app_db_rows_total{route="get_import"')]
+        # citizens and their relations are fetched by every request
+        assert int(rows[0].split()[-1]) == 3 * (3 + 2)
+
+        rv = client.get('/metrics/profiles')
+        assert rv.status_code == 200
+        assert rv.data.decode().count('function calls') == 2
+    finally:
+        app.config['INSTRUMENTATION'] = False
+        app.config['PROFILE_SLOWEST'] = 0
+        app.config['RESPONSE_CACHE'] = True
+        metrics.reset()
+
+    rv = client.get('/imports/{}/citizens/birthdays'.format(import_id))
+    assert 'Server-Timing' not in rv.headers
+
+
+def test_import_snapshots(client):
+    # analytics computed from snapshot are the same as from database, snapshot follows PATCHes in place
+    from app.snapshots import snapshots
+    rnd = random.Random(18)
+
+    def birth_date():
+        return '{:02d}.{:02d}.{}'.format(rnd.randint(1, 28), rnd.randint(1, 12), rnd.randint(1950, 2010))
+
+    citizens = [{'citizen_id': i, 'town': rnd.choice(['Москва', 'Керчь', 'Тверь']), 'street': 'Льва Толстого',
+                 'building': '16к7стр5', 'apartment': i, 'name': 'Иванов Иван', 'gender': 'male',
+                 'birth_date': birth_date(), 'relatives': []} for i in range(1, 41)]
+    for _ in range(60):
+        first, second = rnd.sample(citizens, 2)
+        if second['citizen_id'] not in first['relatives']:
+            first['relatives'].append(second['citizen_id'])
+            second['relatives'].append(first['citizen_id'])
+    rv = client.post('/imports', data=json.dumps({'citizens': citizens}), content_type='application/json')
+    assert rv.status_code == 201
+    import_id = json.loads(rv.data)['data']['import_id']
+
+    def responses():
+        result = []
+        for enabled in (True, False):
+            app.config['IMPORT_SNAPSHOTS'] = enabled
+            try:
+                for route in ['citizens/birthdays', 'towns/stat/percentile/age']:
+                    rv = client.get('/imports/{}/{}'.format(import_id, route))
+                    assert rv.status_code == 200
+                    result.append(json.loads(rv.data))
+            finally:
+                app.config['IMPORT_SNAPSHOTS'] = True
+        return result[:2], result[2:]
+
+    app.config['RESPONSE_CACHE'] = False
+    try:
+        from_snapshot, from_database = responses()
+        assert from_snapshot == from_database
+        snapshot = snapshots.entries[import_id]
+
+        for _ in range(20):
+            citizen_id = rnd.randint(1, 40)
+            changes = rnd.choice([
+                {'town': rnd.choice(['Москва', 'Керчь', 'Тверь', 'Омск'])},
+                {'birth_date': birth_date()},
+                {'relatives': rnd.sample([i for i in range(1, 41) if i != citizen_id], rnd.randint(0, 4))},
+            ])
+            rv = client.patch('/imports/{}/citizens/{}'.format(import_id, citizen_id),
+                              data=json.dumps(changes), content_type='application/json')
+            assert rv.status_code == 200
+            from_snapshot, from_database = responses()
+            assert from_snapshot == from_database, changes
+            # patched, not rebuilt
+            assert snapshots.entries[import_id] is snapshot
+
+        # snapshots do not outgrow the limit
+        snapshots.clear()
+        max_bytes = snapshots.max_bytes
+        snapshots.max_bytes = snapshot.nbytes // 2
+        try:
+            assert responses()[0] == from_database
+            assert import_id not in snapshots.entries
+        finally:
+            snapshots.max_bytes = max_bytes
+    finally:
+        app.config['RESPONSE_CACHE'] = True
+
+
+def test_fast_json(client):
+    # orjson and stdlib encoders give the same documents with the same key order
+    with open('tests/citizens2.json') as f:
+        original_data = json.load(f)
+    rv = client.post('/imports', data=json.dumps(original_data), content_type='application/json')
+    assert rv.status_code == 201
+    import_id = json.loads(rv.data)['data']['import_id']
+    keys = ['citizen_id', 'town', 'street', 'building', 'apartment', 'name', 'birth_date', 'gender', 'relatives']
+
+    responses = []
+    app.config['RESPONSE_CACHE'] = False
+    try:
+        for fast_json in (True, False):
+            app.config['FAST_JSON'] = fast_json
+            rv = client.get('/imports/{}/citizens'.format(import_id))
+            assert rv.status_code == 200
+            citizens = json.loads(rv.data, object_pairs_hook=lambda pairs: pairs)[0][1]
+            assert all([key for key, _ in citizen] == keys for citizen in citizens)
+            responses.append(json.loads(rv.data))
+
+        for fast_json, name in ((True, 'Ёжик'), (False, 'Ёж')):
+            app.config['FAST_JSON'] = fast_json
+            rv = client.patch('/imports/{}/citizens/1'.format(import_id), data=json.dumps({'name': name}),
+                              content_type='application/json')
+            assert rv.status_code == 200
+            citizen = json.loads(rv.data, object_pairs_hook=lambda pairs: pairs)[0][1]
+            assert [key for key, _ in citizen] == keys
+            assert dict(citizen)['name'] == name
+    finally:
+        app.config['FAST_JSON'] = True
+        app.config['RESPONSE_CACHE'] = True
+    assert responses[0] == responses[1]
+
+
+def test_binary_export(client):
+    # export and import of citizens file keep the import, file is read with mmap by analytics
+    from app.binary import CitizenFile
+    with open('tests/citizens2.json') as f:
+        original_data = json.load(f)
+    rv = client.post('/imports', data=json.dumps(original_data), content_type='application/json')
+    assert rv.status_code == 201
+    import_id = json.loads(rv.data)['data']['import_id']
+
+    rv = client.get('/imports/{}/export'.format(import_id))
+    assert rv.status_code == 200
+    exported = rv.data
+    rv = client.post('/imports/binary', data=exported, content_type='application/octet-stream')
+    assert rv.status_code == 201
+    copy_id = json.loads(rv.data)['data']['import_id']
+    for route in ['citizens', 'citizens/birthdays', 'towns/stat/percentile/age']:
+        expected = json.loads(client.get('/imports/{}/{}'.format(import_id, route)).data)
+        assert json.loads(client.get('/imports/{}/{}'.format(copy_id, route)).data) == expected, route
+    rv = client.get('/imports/{}/export'.format(copy_id))
+    assert rv.data == exported
+    rv = client.post('/imports/binary', data=exported, content_type='application/octet-stream',
+                     headers={'Prefer': 'respond-async'})
+    assert rv.status_code == 202
+    job = wait_for_job(client, json.loads(rv.data)['data']['job_id'])
+    assert job['status'] == 'done'
+    copy_id = job['import_id']
+
+    with tempfile.TemporaryFile() as f:
+        f.write(exported)
+        f.flush()
+        with CitizenFile.open(f) as data:
+            data.validate()
+            assert data.count == len(original_data['citizens'])
+            rv = client.get('/imports/{}/towns/stat/percentile/age'.format(import_id))
+            assert data.snapshot().age_percentiles() == json.loads(rv.data)['data']
+
+    # broken files are rejected and nothing is stored
+    header = 48
+    data = CitizenFile(exported)
+    corrupted = [b'', exported[:header], b'X' + exported[1:], exported + b'\0' * 8]
+    for name, value in [('apartments', -1), ('genders', 2), ('birth_dates', 10 ** 6), ('towns', 10 ** 6),
+                        ('relatives', -1), ('relatives', data.relatives[0] + 1), ('citizen_ids', 10 ** 6),
+                        ('citizen_ids', 0),
+                        ('offsets', 1), ('string_offsets', 1)]:
+        array = getattr(data, name)
+        body = bytearray(exported)
+        offset = header + array.ctypes.data - data.citizen_ids.ctypes.data
+        numpy.frombuffer(body, array.dtype, len(array), offset)[0] = value
+        corrupted.append(bytes(body))
+    for body in corrupted:
+        rv = client.post('/imports/binary', data=body, content_type='application/octet-stream')
+        assert rv.status_code == 400, body[:header]
+    rv = client.get('/imports/{}/citizens'.format(copy_id + 1))
+    assert rv.status_code == 400
+
+    rv = client.get('/imports/{}/export'.format(copy_id + 1))
+    assert rv.status_code == 400
+
+    # streams with a descriptor that can not be mapped (sockets, pipes) are spooled
+    import threading
+    from app import binary
+    read_end, write_end = os.pipe()
+
+    def upload():
+        with open(write_end, 'wb') as writer:
+            writer.write(exported)
+
+    uploader = threading.Thread(target=upload)
+    uploader.start()
+    with open(read_end, 'rb') as pipe, app.test_request_context():
+        pipe_id = binary.import_stream(pipe)
+    uploader.join()
+    assert client.get('/imports/{}/export'.format(pipe_id)).data == exported
+
+
+def test_patch_batch(client):
+    # batch PATCH gives the same result as single PATCHes in the same order, invalid batch changes nothing
+    rnd = random.Random(21)
+    citizens = [{'citizen_id': i, 'town': rnd.choice(['Москва', 'Керчь', 'Тверь']), 'street': 'Льва Толстого',
+                 'building': '16к7стр5', 'apartment': i, 'name': 'Иванов Иван', 'gender': 'male',
+                 'birth_date': '{:02d}.{:02d}.1980'.format(i % 28 + 1, i % 12 + 1), 'relatives': []}
+                for i in range(1, 31)]
+    for _ in range(40):
+        first, second = rnd.sample(citizens, 2)
+        if second['citizen_id'] not in first['relatives']:
+            first['relatives'].append(second['citizen_id'])
+            second['relatives'].append(first['citizen_id'])
+    import_ids = []
+    for _ in range(2):
+        rv = client.post('/imports', data=json.dumps({'citizens': citizens}), content_type='application/json')
+        assert rv.status_code == 201
+        import_ids.append(json.loads(rv.data)['data']['import_id'])
+    single_id, batch_id = import_ids
+
+    edits = []
+    for citizen_id in rnd.sample(range(1, 31), 12):
+        changes = {'town': rnd.choice(['Москва', 'Керчь', 'Тверь', 'Омск']),
+                   'birth_date': '{:02d}.{:02d}.19{}'.format(rnd.randint(1, 28), rnd.randint(1, 12),
+                                                              rnd.randint(50, 99))}
+        if rnd.random() < 0.7:
+            changes['relatives'] = rnd.sample([i for i in range(1, 31) if i != citizen_id], rnd.randint(0, 4))
+        edits.append({'citizen_id': citizen_id, 'changes': changes})
+
+    expected = []
+    for edit in edits:
+        rv = client.patch('/imports/{}/citizens/{}'.format(single_id, edit['citizen_id']),
+                          data=json.dumps(edit['changes']), content_type='application/json')
+        assert rv.status_code == 200
+    for edit in edits:
+        citizen = next(person for person in json.loads(client.get('/imports/{}/citizens'.format(single_id)).data)[
+            'data'] if person['citizen_id'] == edit['citizen_id'])
+        expected.append(citizen)
+
+    rv = client.patch('/imports/{}/citizens'.format(batch_id), data=json.dumps({'citizens': edits}),
+                      content_type='application/json')
+    assert rv.status_code == 200
+    assert json.loads(rv.data)['data'] == expected
+    for route in ['citizens', 'citizens/birthdays', 'towns/stat/percentile/age']:
+        single = json.loads(client.get('/imports/{}/{}'.format(single_id, route)).data)
+        assert json.loads(client.get('/imports/{}/{}'.format(batch_id, route)).data) == single, route
+
+    before = json.loads(client.get('/imports/{}/citizens'.format(batch_id)).data)
+    valid = {'citizen_id': 1, 'changes': {'name': 'Петров Петр', 'relatives': [2]}}
+    for body in [{}, {'citizens': []}, {'citizens': [valid, valid]},
+                 {'citizens': [valid, {'citizen_id': 2, 'changes': {}}]},
+                 {'citizens': [valid, {'citizen_id': 2, 'changes': {'name': 2}}]},
+                 {'citizens': [valid, {'citizen_id': 2, 'changes': {'citizen_id': 3}}]},
+                 {'citizens': [valid, {'citizen_id': 99, 'changes': {'name': 'Петров Петр'}}]},
+                 {'citizens': [valid, {'citizen_id': 2, 'changes': {'relatives': [2]}}]},
+                 {'citizens': [valid, {'citizen_id': 2, 'changes': {'relatives': [99]}}]},
+                 {'citizens': [valid, {'citizen_id': 2}]}]:
+        rv = client.patch('/imports/{}/citizens'.format(batch_id), data=json.dumps(body),
+                          content_type='application/json')
+        assert rv.status_code == 400, body
+    assert json.loads(client.get('/imports/{}/citizens'.format(batch_id)).data) == before
+    rv = client.patch('/imports/{}/citizens'.format(batch_id + 1), data=json.dumps({'citizens': [valid]}),
+                      content_type='application/json')
+    assert rv.status_code == 400
+
+
+def test_read_replicas(client):
+    # GET routes read from a replica, writers read their own writes from the primary for a while
+    import sqlite3
+    from app import replicas
+    primary = app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+    replica_fd, replica_name = tempfile.mkstemp()
+    with open('tests/citizens1.json') as f:
+        original_data = json.load(f)
+    app.config['SQLALCHEMY_REPLICA_URIS'] = ['sqlite:///' + replica_name]
+    app.config['RESPONSE_CACHE'] = False
+    try:
+        db.metadata.create_all(replicas.engine('sqlite:///' + replica_name))
+        rv = client.post('/imports', data=json.dumps(original_data), content_type='application/json')
+        assert rv.status_code == 201
+        import_id = json.loads(rv.data)['data']['import_id']
+        rv = client.get('/imports/{}/citizens'.format(import_id))
+        assert json.loads(rv.data)['data'] == original_data['citizens']
+
+        # replica is empty until "replicated"
+        reader = app.test_client()
+        rv = reader.get('/imports/{}/citizens'.format(import_id))
+        assert rv.status_code == 400
+        db.session.remove()
+        source, target = sqlite3.connect(primary), sqlite3.connect(replica_name)
+        source.backup(target)
+        source.close()
+        target.close()
+        rv = reader.get('/imports/{}/citizens'.format(import_id))
+        assert json.loads(rv.data)['data'] == original_data['citizens']
+
+        rv = client.patch('/imports/{}/citizens/1'.format(import_id), data=json.dumps({'name': 'Ёжик'}),
+                          content_type='application/json')
+        assert rv.status_code == 200
+        rv = client.get('/imports/{}/citizens'.format(import_id))
+        assert json.loads(rv.data)['data'][0]['name'] == 'Ёжик'
+        rv = reader.get('/imports/{}/citizens'.format(import_id))
+        assert json.loads(rv.data)['data'][0]['name'] == original_data['citizens'][0]['name']
+        rv = reader.get('/imports/{}/citizens/birthdays'.format(import_id))
+        assert rv.status_code == 200
+        # stickiness is scoped to the written import
+        rv = client.get('/imports/{}/citizens'.format(import_id + 1))
+        assert rv.status_code == 400
+    finally:
+        app.config['SQLALCHEMY_REPLICA_URIS'] = []
+        app.config['RESPONSE_CACHE'] = True
+        db.session.remove()
+        os.close(replica_fd)
+        os.unlink(replica_name)
+
+
+def test_citizens_pages(client):
+    # keyset pagination and field projection of GET /imports/$import_id/citizens
+    with open('tests/citizens2.json') as f:
+        original_data = json.load(f)
+    rv = client.post('/imports', data=json.dumps(original_data), content_type='application/json')
+    assert rv.status_code == 201
+    import_id = json.loads(rv.data)['data']['import_id']
+    full = json.loads(client.get('/imports/{}/citizens'.format(import_id)).data)['data']
+
+    for fields in [['name', 'town'], ['relatives'], ['birth_date', 'citizen_id'], list(full[0])]:
+        rv = client.get('/imports/{}/citizens?fields={}'.format(import_id, ','.join(fields)))
+        assert rv.status_code == 200
+        projected = json.loads(rv.data, object_pairs_hook=lambda pairs: pairs)[0][1]
+        expected = [[(key, value) for key, value in citizen.items() if key in fields] for citizen in full]
+        assert [[(key, value) for key, value in citizen] for citizen in projected] == expected
+
+    for limit, fields in [(1, 'name'), (333, 'citizen_id,relatives'), (len(full), 'gender'), (10000, 'town')]:
+        pages = []
+        after = None
+        while True:
+            url = '/imports/{}/citizens?limit={}&fields={}'.format(import_id, limit, fields)
+            if after is not None:
+                url += '&after={}'.format(after)
+            rv = client.get(url)
+            assert rv.status_code == 200
+            page = json.loads(rv.data)
+            assert 0 < len(page['data']) <= limit
+            pages.extend(page['data'])
+            after = page['next']
+            if after is None or limit == 1 and len(pages) == 20:
+                break
+        names = fields.split(',')
+        assert pages == [{key: value for key, value in citizen.items() if key in names}
+                         for citizen in full[:len(pages)]]
+        if limit != 1:
+            assert len(pages) == len(full)
+
+    rv = client.get('/imports/{}/citizens?after={}'.format(import_id, full[-3]['citizen_id']))
+    assert json.loads(rv.data)['data'] == full[-2:]
+    rv = client.get('/imports/{}/citizens?after={}&limit=5'.format(import_id, full[-1]['citizen_id']))
+    assert json.loads(rv.data) == {'data': [], 'next': None}
+
+    for query in ['fields=', 'fields=name,uuid', 'limit=0', 'limit=10001', 'limit=a', 'after=1.5']:
+        rv = client.get('/imports/{}/citizens?{}'.format(import_id, query))
+        assert rv.status_code == 400, query
+
+
+def test_compression(client):
+    # large responses are compressed with negotiated encoding, compressed bodies are cached
+    import gzip
+    from app import compress
+    with open('tests/citizens2.json') as f:
+        original_data = json.load(f)
+    rv = client.post('/imports', data=json.dumps(original_data), content_type='application/json')
+    assert rv.status_code == 201
+    import_id = json.loads(rv.data)['data']['import_id']
+    decoders = {'gzip': gzip.decompress,
+                'zstd': lambda body: compress.zstandard.ZstdDecompressor().decompressobj().decompress(body)}
+    with_zstd = compress.zstandard is not None
+
+    for route in ['citizens', 'citizens/birthdays', 'towns/stat/percentile/age']:
+        url = '/imports/{}/{}'.format(import_id, route)
+        plain = client.get(url, headers={'Accept-Encoding': 'identity'}, buffered=True)
+        assert 'Content-Encoding' not in plain.headers
+        for accept, encoding in [('gzip', 'gzip'), ('gzip, zstd', 'zstd' if with_zstd else 'gzip'),
+                                 ('zstd;q=0.5, gzip', 'gzip'), ('*', 'zstd' if with_zstd else 'gzip'),
+                                 ('zstd', 'zstd' if with_zstd else None), ('gzip;q=0', None)]:
+            for _ in range(2):
+                rv = client.get(url, headers={'Accept-Encoding': accept})
+                assert rv.status_code == 200
+                if encoding is None or len(plain.data) < app.config['COMPRESSION_MIN_BYTES']:
+                    assert 'Content-Encoding' not in rv.headers
+                    assert rv.data == plain.data
+                    continue
+                assert rv.headers['Content-Encoding'] == encoding, accept
+                assert 'Accept-Encoding' in rv.headers['Vary']
+                assert decoders[encoding](rv.data) == plain.data
+                # weak ETag of the plain body is accepted in If-None-Match
+                assert rv.headers['ETag'] == 'W/' + plain.headers['ETag']
+                rv = client.get(url, headers={'Accept-Encoding': accept, 'If-None-Match': rv.headers['ETag']})
+                assert rv.status_code == 304
+
+    # compressed bodies are stored next to the plain one and dropped by PATCH
+    url = '/imports/{}/citizens'.format(import_id)
+    etag = client.get(url).headers['ETag'].strip('"')
+    assert compress.response_cache.backend.get((import_id, etag, 'gzip')) is not None
+    rv = client.patch('/imports/{}/citizens/1'.format(import_id), data=json.dumps({'name': 'Ёжик'}),
+                      content_type='application/json')
+    assert rv.status_code == 200
+    assert compress.response_cache.backend.get((import_id, etag, 'gzip')) is None
+    rv = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert json.loads(gzip.decompress(rv.data))['data'][0]['name'] == 'Ёжик'
+
+    app.config['RESPONSE_CACHE'] = False
+    try:
+        for enabled in (True, False):
+            app.config['COMPRESSION'] = enabled
+            rv = client.get(url, headers={'Accept-Encoding': 'gzip'})
+            assert ('Content-Encoding' in rv.headers) == enabled
+            assert json.loads(gzip.decompress(rv.data) if enabled else rv.data)['data'][0]['name'] == 'Ёжик'
+    finally:
+        app.config['COMPRESSION'] = True
+        app.config['RESPONSE_CACHE'] = True
+
+
+def test_presents_table(client):
+    # presents table patched by deltas equals full recomputation after random PATCH sequences
+    from app import presents
+    for seed in range(5):
+        rnd = random.Random(seed)
+        size = rnd.randint(2, 25)
+
+        def birth_date():
+            return '{:02d}.{:02d}.{}'.format(rnd.randint(1, 28), rnd.randint(1, 12), rnd.randint(1950, 2010))
+
+        citizens = [{'citizen_id': i, 'town': 'Москва', 'street': 'Льва Толстого', 'building': '16к7стр5',
+                     'apartment': i, 'name': 'Иванов Иван', 'gender': 'male', 'birth_date': birth_date(),
+                     'relatives': []} for i in range(1, size + 1)]
+        for _ in range(rnd.randint(0, size * 2)):
+            first, second = rnd.sample(citizens, 2)
+            if second['citizen_id'] not in first['relatives']:
+                first['relatives'].append(second['citizen_id'])
+                second['relatives'].append(first['citizen_id'])
+        # every way of importing fills the table
+        app.config['IMPORT_STREAM_MIN_BYTES'] = 0 if seed % 2 else 4 * 1024 * 1024
+        try:
+            rv = client.post('/imports', data=json.dumps({'citizens': citizens}), content_type='application/json')
+        finally:
+            app.config['IMPORT_STREAM_MIN_BYTES'] = 4 * 1024 * 1024
+        assert rv.status_code == 201
+        import_ids = [json.loads(rv.data)['data']['import_id']]
+        rv = client.post('/imports/binary', data=client.get('/imports/{}/export'.format(import_ids[0])).data,
+                         content_type='application/octet-stream')
+        assert rv.status_code == 201
+        import_ids.append(json.loads(rv.data)['data']['import_id'])
+
+        def random_changes(citizen_id):
+            changes = {}
+            if rnd.random() < 0.6:
+                changes['birth_date'] = birth_date()
+            if rnd.random() < 0.6 or not changes:
+                others = [i for i in range(1, size + 1) if i != citizen_id]
+                changes['relatives'] = rnd.sample(others, rnd.randint(0, min(4, len(others))))
+            return changes
+
+        for step in range(15):
+            for import_id in import_ids:
+                if rnd.random() < 0.5:
+                    citizen_id = rnd.randint(1, size)
+                    rv = client.patch('/imports/{}/citizens/{}'.format(import_id, citizen_id),
+                                      data=json.dumps(random_changes(citizen_id)), content_type='application/json')
+                else:
+                    edits = [{'citizen_id': citizen_id, 'changes': random_changes(citizen_id)}
+                             for citizen_id in rnd.sample(range(1, size + 1), rnd.randint(1, min(size, 5)))]
+                    rv = client.patch('/imports/{}/citizens'.format(import_id), data=json.dumps({'citizens': edits}),
+                                      content_type='application/json')
+                assert rv.status_code == 200
+                with app.app_context():
+                    expected = presents.recompute(import_id)
+                    assert presents.birthdays(import_id) == expected, (seed, step)
+                rv = client.get('/imports/{}/citizens/birthdays'.format(import_id))
+                assert json.loads(rv.data)['data'] == expected
+
+
+def test_migrate_baseline(client):
+    # database of the first version of the service is converted by every migration step
+    import pickle
+    from app import migrate, presents
+    with open('tests/citizens1.json') as f:
+        citizens = json.load(f)['citizens']
+    db.drop_all()
+    engine = db.get_engine()
+    engine.execute('CREATE TABLE citizens ('
+                   'uuid VARCHAR(32) NOT NULL PRIMARY KEY, citizen_id INTEGER, import_id INTEGER, '
+                   'town VARCHAR, street VARCHAR, building VARCHAR, apartment INTEGER, name VARCHAR, '
+                   'birth_date DATETIME, gender VARCHAR, relatives BLOB)')
+    for import_id in (1, 2):
+        for person in citizens:
+            birth_date = datetime.strptime(person['birth_date'], '%d.%m.%Y')
+            engine.execute('INSERT INTO citizens VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           '{}-{}'.format(import_id, person['citizen_id']), person['citizen_id'], import_id,
+                           person['town'], person['street'], person['building'], person['apartment'],
+                           person['name'], birth_date, person['gender'], pickle.dumps(person['relatives']))
+    engine.dispose()
+
+    migrate.migrate(app.config['SQLALCHEMY_DATABASE_URI'])
+    # second run finds nothing to do
+    migrate.migrate(app.config['SQLALCHEMY_DATABASE_URI'])
+
+    # migrated citizens table has the same keys and indexes as one made by db.create_all()
+    from sqlalchemy import inspect
+    migrated = inspect(db.get_engine())
+    assert migrated.get_pk_constraint('citizens')['constrained_columns'] == ['import_id', 'citizen_id']
+    assert [(key['constrained_columns'], key['referred_table'], key['referred_columns'])
+            for key in migrated.get_foreign_keys('citizens')] == [(['import_id'], 'imports', ['id'])]
+    # inspector skips expression indexes of SQLite
+    indexes = db.get_engine().execute("SELECT name FROM sqlite_master "
+                                      "WHERE type = 'index' AND tbl_name = 'citizens' AND sql IS NOT NULL")
+    assert {name for name, in indexes} == {index.name for index in db.Model.metadata.tables['citizens'].indexes}
+
+    for import_id in (1, 2):
+        rv = client.get('/imports/{}/citizens'.format(import_id))
+        assert rv.status_code == 200
+        data = json.loads(rv.data)['data']
+        for person in data:
+            person['relatives'].sort()
+        assert data == sorted(citizens, key=lambda person: person['citizen_id'])
+        with app.app_context():
+            assert presents.birthdays(import_id) == presents.recompute(import_id)
+            assert any(presents.birthdays(import_id).values())
+        rv = client.get('/imports/{}/towns/stat/percentile/age'.format(import_id))
+        assert rv.status_code == 200
+
+    # ids of new imports continue after migrated ones
+    rv = client.post('/imports', data=json.dumps({'citizens': citizens}), content_type='application/json')
+    assert json.loads(rv.data)['data']['import_id'] == 3